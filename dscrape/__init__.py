@@ -17,6 +17,7 @@ import traceback
 import logging
 import os
 import sys
+import asyncio
 import datetime
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
@@ -25,11 +26,45 @@ from . import constants
 from . import dataUtil
 from . import extractor
 from . import database
+from . import dbPool
+from . import metrics
+from . import pipeline
+from .downloader import pool
+from .downloader import limiter
+from .downloader import resilience
+from .downloader import latency
 
 import py_core
 from py_core import logging_util
 
 
+# (school_id, term_ids) of every school whose terms were scraped and written completely,
+# a term is only in here once every write of it is in the database
+old_data_to_delete: list[tuple[int, list[int]]] = []
+
+
+def queue_old_data_delete(dumper: extractor.CourseScraper):
+    # the writers still add terms to completed_term_ids, it is only read after they stopped
+    if dumper.school_id is not None:
+        old_data_to_delete.append((dumper.school_id, dumper.completed_term_ids))
+
+
+def delete_old_data():
+    if metrics.get("pipeline.failed_writes"):
+        logging.warning("Some course data could not be written, the old data of those terms is kept")
+
+    for school_id, term_ids in old_data_to_delete:
+        if not term_ids:
+            continue
+
+        try:
+            database.delete_old_data(school_id, term_ids)
+
+        except Exception as e:
+            logging.error(f"Could not delete old data for {school_id}")
+            logging.error(e)
+            logging.error(traceback.format_exc())
+
 
 def scrape_course_information(dumper: extractor.CourseScraper, debug_break_1=False):
     try:
@@ -38,19 +73,54 @@ def scrape_course_information(dumper: extractor.CourseScraper, debug_break_1=Fal
         dumper.scrape_and_dump(debug_break_1)
         
         logging.debug(f"Course dumper id is {dumper.school_id}")
-        
-        # if dumper.school_id is not None:
-
-        #    database.delete_old_data(dumper.school_id)
             
     except KeyboardInterrupt:
         logging.info("Keyboard Interrupt, exiting thread")
 
+    except resilience.CircuitOpenError as e:
+        logging.error(f"Skipping the rest of {dumper}: {e}")
+
     except Exception as e:
         logging.error("Unknown error has occured!")
         logging.error(e)
         logging.error(traceback.format_exc())
 
+    finally:
+        if isinstance(dumper, extractor.CourseScraper):
+            queue_old_data_delete(dumper)
+            dumper.close()
+
+
+async def scrape_course_information_async(dumper: type[extractor.CourseScraper], debug_break_1=False):
+    async_dumper = None
+    try:
+        async_dumper = extractor.AsyncCourseDumper(dumper)
+
+        await async_dumper.scrape_and_dump(debug_break_1)
+
+        logging.debug(f"Course dumper id is {async_dumper.school_id}")
+
+    except resilience.CircuitOpenError as e:
+        logging.error(f"Skipping the rest of {async_dumper}: {e}")
+
+    except Exception as e:
+        logging.error("Unknown error has occured!")
+        logging.error(e)
+        logging.error(traceback.format_exc())
+
+    finally:
+        if async_dumper is not None:
+            queue_old_data_delete(async_dumper)
+            await async_dumper.aclose()
+
+
+async def scrape_all_async(extractors_to_use: list[type[extractor.CourseScraper]]):
+    try:
+        await asyncio.gather(*(scrape_course_information_async(i) for i in extractors_to_use))
+    finally:
+        await pool.aclose_all()
+        await database.aclose_async_database()
+
 
 def list_extractors():
     max_width = len(str(len(extractor.extractors)))
@@ -101,9 +171,100 @@ def get_and_prase_args(args):
     general.add_argument("-H", "--host", dest="db_host", help="The database host")
     general.add_argument("-n", "--db_name", dest="db_name", help="The database name")
     general.add_argument("-P", "--port", dest="db_port", help="The database port")
+    general.add_argument(
+        "--db-pool-size",
+        dest="db_pool_size",
+        type=int,
+        help="The number of database connections to keep open, sized from the threads and writers by default",
+    )
     general.add_argument(
         "-t", "--threads", dest="threads", help="The number of extractors to run at a single time"
     )
+    general.add_argument(
+        "-a",
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run every extractor on a single asyncio event loop instead of a thread pool",
+    )
+    general.add_argument(
+        "--async-db",
+        dest="async_db",
+        nargs="?",
+        const="aiomysql",
+        help="Write to the database from the event loop with the given async driver (aiomysql by default), needs --async",
+    )
+    general.add_argument(
+        "-C",
+        "--max-connections",
+        dest="max_connections",
+        type=int,
+        help="The max number of connections to open against a single host",
+    )
+    general.add_argument(
+        "--hedge",
+        dest="hedge",
+        action="store_true",
+        help="Send a duplicate course data request when one is slower than the host's p95 latency",
+    )
+    general.add_argument(
+        "-T",
+        "--term-sessions",
+        dest="term_sessions",
+        type=int,
+        help="The number of terms each extractor scrapes at the same time, each uses its own session",
+    )
+    general.add_argument(
+        "-w",
+        "--writers",
+        dest="writers",
+        type=int,
+        help="The number of threads that write course data to the database",
+    )
+    general.add_argument(
+        "--write-queue",
+        dest="write_queue",
+        type=int,
+        help="The number of course data batches that can wait for a database writer",
+    )
+    general.add_argument(
+        "--commit-size",
+        dest="commit_size",
+        type=int,
+        help="The number of sections written per database transaction, 0 writes each batch in one transaction",
+    )
+    general.add_argument(
+        "--savepoint-size",
+        dest="savepoint_size",
+        type=int,
+        help="The number of sections per savepoint, a section that can not be written is skipped instead of its whole transaction, 0 turns it off",
+    )
+    general.add_argument(
+        "--merge-terms",
+        dest="merge_terms",
+        action="store_true",
+        help="Write each term at once through staging tables when it is done, instead of a batch at a time",
+    )
+    general.add_argument(
+        "--prefetch",
+        dest="prefetch",
+        type=int,
+        help="The number of course data batches to download ahead while one is written to the database",
+    )
+    general.add_argument(
+        "--batch-sizes",
+        dest="batch_sizes",
+        help="The json file the learned course data batch sizes are saved to between runs",
+    )
+    general.add_argument(
+        "--delete-old",
+        dest="delete_old",
+        action="store_true",
+        help="Delete the course data that was not seen by this scrape, only for terms that were scraped completely",
+    )
+    general.add_argument(
+        "--no-http2", dest="no_http2", action="store_true", help="Only use HTTP/1.1 connections"
+    )
     general.add_argument("-L", "--loglevel", dest="log_level", help=f"Set the log level, {logging_util.get_level_map_pretty()}")
     general.add_argument("-f", "--logfile", dest="log_file", help="Set the NAME of the logfile, will be put in the log directory")
     general.add_argument("-D", "--logdir", dest="log_dir", help="Set the log directroy")
@@ -178,6 +339,74 @@ def main():
             logging.error("Thread count must be larger than 0!")
             return 1
 
+    if not parsed_args.max_connections:
+        parsed_args.max_connections = dataUtil.parse_int(os.getenv("MAX_CONNECTIONS_PER_HOST", 10), 10)
+
+    if parsed_args.max_connections <= 0:
+        logging.error("Max connections must be larger than 0!")
+        return 1
+
+    pool.configure(max_connections=parsed_args.max_connections, http2=not parsed_args.no_http2)
+    limiter.configure(max_concurrency=parsed_args.max_connections)
+
+    extractor.DumperConfig.hedge_course_data = parsed_args.hedge
+
+    if parsed_args.writers is not None and parsed_args.writers <= 0:
+        logging.error("Writers must be larger than 0!")
+        return 1
+
+    if parsed_args.write_queue is not None and parsed_args.write_queue <= 0:
+        logging.error("Write queue must be larger than 0!")
+        return 1
+
+    pipeline.configure(writers=parsed_args.writers, queue_size=parsed_args.write_queue)
+
+    if parsed_args.commit_size is not None:
+        if parsed_args.commit_size < 0:
+            logging.error("Commit size must not be negative!")
+            return 1
+
+        database.WriteConfig.commit_size = parsed_args.commit_size
+
+    if parsed_args.savepoint_size is not None:
+        if parsed_args.savepoint_size < 0:
+            logging.error("Savepoint size must not be negative!")
+            return 1
+
+        database.WriteConfig.savepoint_size = parsed_args.savepoint_size
+
+    database.WriteConfig.merge_terms = parsed_args.merge_terms
+
+    if parsed_args.async_db and not parsed_args.use_async:
+        logging.error("The async database needs --async!")
+        return 1
+
+    if parsed_args.db_pool_size is not None:
+        if parsed_args.db_pool_size <= 0:
+            logging.error("Database pool size must be larger than 0!")
+            return 1
+
+        dbPool.PoolConfig.size = parsed_args.db_pool_size
+
+    if parsed_args.prefetch is not None:
+        if parsed_args.prefetch < 0:
+            logging.error("Prefetch must not be negative!")
+            return 1
+
+        extractor.DumperConfig.prefetch_depth = parsed_args.prefetch
+
+    if not parsed_args.batch_sizes:
+        parsed_args.batch_sizes = os.getenv("BATCH_SIZES_FILE", "./batch_sizes.json")
+
+    extractor.batchPlanner.configure(state_path=parsed_args.batch_sizes)
+
+    if parsed_args.term_sessions is not None:
+        if parsed_args.term_sessions <= 0:
+            logging.error("Term sessions must be larger than 0!")
+            return 1
+
+        extractor.DumperConfig.term_sessions = parsed_args.term_sessions
+
     extractors_to_use = extractor.extractors.copy()
 
     if parsed_args.scrape:
@@ -202,10 +431,24 @@ def main():
 
     logging.info(f"Read hostname {parsed_args.db_host}")
     logging.info(f"Read port {parsed_args.db_port}")
+    logging.info(f"Read db pool size {dbPool.PoolConfig.size}")
     logging.info(f"Read database name {parsed_args.db_name}")
     logging.info(f"Read username {parsed_args.db_username}")
     logging.info(f"Read password {'*'*len(parsed_args.db_password)}")
     logging.info(f"Read threads {parsed_args.threads}")
+    logging.info(f"Read async {parsed_args.use_async}")
+    logging.info(f"Read async database {parsed_args.async_db}")
+    logging.info(f"Read max connections per host {parsed_args.max_connections}")
+    logging.info(f"Read hedge {parsed_args.hedge}")
+    logging.info(f"Read term sessions {extractor.DumperConfig.term_sessions}")
+    logging.info(f"Read delete old {parsed_args.delete_old}")
+    logging.info(f"Read writers {pipeline.PipelineConfig.writers}")
+    logging.info(f"Read write queue {pipeline.PipelineConfig.queue_size}")
+    logging.info(f"Read prefetch {extractor.DumperConfig.prefetch_depth}")
+    logging.info(f"Read commit size {database.WriteConfig.commit_size}")
+    logging.info(f"Read savepoint size {database.WriteConfig.savepoint_size}")
+    logging.info(f"Read merge terms {database.WriteConfig.merge_terms}")
+    logging.info(f"Read batch sizes file {parsed_args.batch_sizes}")
 
     database.init_database(
         use_mysql=True,
@@ -218,6 +461,27 @@ def main():
         load_env=False,
     )
 
+    # every term an extractor is scraping, every writer and the main thread can hold a connection
+    database.configure_pool(
+        parsed_args.threads * extractor.DumperConfig.term_sessions
+        + pipeline.PipelineConfig.writers
+        + 1
+    )
+
+    if not database.HAS_CONTENT_HASH:
+        logging.info(
+            "TBL_Course_Data has no content_hash column, unchanged sections will still rewrite their faculty and meetings"
+        )
+
+    if parsed_args.async_db:
+        try:
+            database.init_async_database(parsed_args.async_db)
+
+        except Exception as e:
+            # greenlet or the driver are not installed
+            logging.error(f"Could not set up the async database with {parsed_args.async_db}: {e}")
+            return 1
+
     if parsed_args.clean:
         if parsed_args.yes_prompt or dataUtil.ask_for_confirmation("Are you sure you want to delete the entire database? "):
             database.drop_all()
@@ -227,23 +491,46 @@ def main():
     try:
         database.get_current_scrape()
 
+        database.load_dimension_caches()
+
+        pipeline.start()
+
         if parsed_args.debug:
             main2()
             return
 
-        with ThreadPoolExecutor(max_workers=parsed_args.threads) as pool:
-            pool.map(scrape_course_information, extractors_to_use)
+        if parsed_args.use_async:
+            asyncio.run(scrape_all_async(extractors_to_use))
+
+        else:
+            with ThreadPoolExecutor(max_workers=parsed_args.threads) as executor:
+                executor.map(scrape_course_information, extractors_to_use)
             
     except KeyboardInterrupt:
         logging.info("Keyboard Interrupt exiting")
 
     finally:
 
+        # the scrape is only finished once everything queued is written
+        pipeline.stop()
+
+        if parsed_args.delete_old:
+            delete_old_data()
+
         try:
             database.write_scrape()
         except Exception as e:
             logging.error(e)
 
+        pool.close_all()
+        extractor.batchPlanner.save_learned_sizes()
+        limiter.log_limits()
+        latency.log_latencies()
+        database.log_dimension_caches()
+        database.log_pool()
+        metrics.log_metrics()
+        metrics.log_peak_rss()
+
         ended_at = dataUtil.time_now_precise()
 
         elapsed = ended_at - started_at
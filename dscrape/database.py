@@ -15,12 +15,38 @@
 
 
 import os
+import json
+import time
+import asyncio
+import random
 import datetime
+import threading
 import logging
 
-from sqlalchemy import Delete
+from typing import Iterable
+
+from sqlalchemy import (
+    Column,
+    Delete,
+    MetaData,
+    Table,
+    and_,
+    event,
+    exists,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.exc import DBAPIError
 
 from . import dataUtil
+from . import dbPool
+from . import metrics
+from .dbCache import DimensionCache, KeyClaim, PartitionedKeyCache, log_caches
 
 from py_core.db import *
 from py_core.db.db_tables import *
@@ -31,6 +57,134 @@ class Scrape:
     Scrape_Time = datetime.datetime.now(datetime.timezone.utc)
     Scrape_id = -1
 
+
+class WriteConfig:
+    # sections written per transaction by add_course_data, 0 writes the whole chunk in one
+    commit_size = 0
+
+    # sections per savepoint in a transaction, a group that fails is written again a section
+    # at a time and the sections that still fail are skipped, 0 does not use savepoints
+    savepoint_size = 0
+
+    # collect each term in a TermLoad and write it with merge_term instead of a chunk at a time
+    merge_terms = False
+
+    # times a transaction that lost a deadlock or timed out waiting for a lock is run again
+    deadlock_retries = 3
+
+
+# mysql errors for a transaction that was rolled back because of a lock, and can just be run again
+# 1213 is ER_LOCK_DEADLOCK and 1205 is ER_LOCK_WAIT_TIMEOUT
+RETRYABLE_ERRORS = (1213, 1205)
+
+
+def get_mysql_errno(e: BaseException):
+    """
+    The mysql error number of a database error, None if it is not one
+
+    Drivers raise them as different DBAPIError subclasses, mysql-connector raises a deadlock
+    as an InternalError and a lock wait timeout as a DatabaseError, so only the number is checked
+    """
+    if not isinstance(e, DBAPIError) or e.orig is None:
+        return None
+
+    errno = getattr(e.orig, "errno", None)
+
+    if errno is None and e.orig.args:
+        errno = e.orig.args[0]
+
+    return errno
+
+
+def get_retryable_errno(e: BaseException):
+    """
+    The mysql error number that makes e worth running the transaction again for, None if there is none
+
+    The errors e was raised while handling are checked too. After a deadlock mysql has rolled back
+    the whole transaction, so rolling back to a savepoint fails with an error of its own
+    """
+    seen = set()
+
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+
+        errno = get_mysql_errno(e)
+
+        if errno in RETRYABLE_ERRORS:
+            return errno
+
+        e = e.__cause__ or e.__context__
+
+    return None
+
+
+def is_retryable(e: BaseException):
+    return get_retryable_errno(e) is not None
+
+
+def run_transaction(function, *args):
+    """
+    Runs function(*args, session) in a transaction of its own and returns what it returns
+
+    The transaction is run again from the start if it loses a deadlock, so function must
+    not have side effects outside of the session that a rollback does not undo
+    """
+    attempt = 0
+
+    while True:
+        try:
+            session: SessionObj
+            with Session().begin() as session:
+                return function(*args, session)
+
+        except DBAPIError as e:
+            attempt += 1
+
+            time.sleep(get_retry_delay(function, e, attempt))
+
+
+def get_retry_delay(function, e: DBAPIError, attempt: int):
+    """
+    Seconds to wait before the attempt at running function again, raises e if it should not be
+    """
+    if not is_retryable(e) or attempt > WriteConfig.deadlock_retries:
+        raise e
+
+    metrics.increment("database.deadlock_retries")
+
+    logging.warning(
+        f"{function.__name__} hit mysql error {get_retryable_errno(e)}, retrying ({attempt}/{WriteConfig.deadlock_retries})"
+    )
+
+    # let whoever won the lock finish before trying again
+    return random.uniform(0, 0.05 * 2**attempt)
+
+
+def configure_pool(size: int):
+    """
+    Binds Session to an engine with a pool of size connections, for the database init_database set up
+    """
+    engine = Session.kw.get("bind", None)
+
+    if engine is None:
+        logging.warning("The database is not initialized, not configuring its pool")
+        return
+
+    if dbPool.PoolConfig.size is not None:
+        size = dbPool.PoolConfig.size
+
+    # not a new engine from engine.url, that would drop the options init_database created it with
+    dbPool.pool_engine(engine, size)
+
+    logging.info(
+        f"Database pool size {size}, overflow {dbPool.PoolConfig.max_overflow}, recycle {dbPool.PoolConfig.recycle}s"
+    )
+
+
+def log_pool():
+    dbPool.log_pool(Session.kw.get("bind", None))
+
+
 def write_scrape():
 
     with Session().begin() as session:
@@ -91,12 +245,12 @@ def get_school_id(school_value: str, subdomain: str, timezone: str):
 
         if result is not None:
             
-            result.scrape_id_last = get_current_scrape()
+            result.scrape_id_last = get_current_scrape_nt(session)
 
             return result.school_id
 
         new_result = TBL_School(school_unique_value=school_value, subdomain=subdomain, timezone=timezone,
-                                scrape_id_last=get_current_scrape())
+                                scrape_id_last=get_current_scrape_nt(session))
         session.add(new_result)
 
         session.flush()
@@ -104,6 +258,113 @@ def get_school_id(school_value: str, subdomain: str, timezone: str):
         return new_result.school_id
 
 
+class_type_cache = DimensionCache("class_type")
+subject_cache = DimensionCache("subject")
+restriction_type_cache = DimensionCache("restriction_type")
+faculty_cache = DimensionCache("faculty")
+
+# the meeting hashes that exist, by term_id
+meeting_hash_cache = PartitionedKeyCache("meeting_hash")
+
+term_cache = DimensionCache("term")
+DIMENSION_CACHES = (
+    class_type_cache,
+    subject_cache,
+    restriction_type_cache,
+    faculty_cache,
+    term_cache,
+)
+
+
+def load_dimension_caches():
+    """
+    Fills the lookup table caches with everything that is already in the database
+    """
+    session: SessionObj
+    with Session().begin() as session:
+        class_type_cache.update(
+            {
+                row.class_type: row.class_type_id
+                for row in session.query(TBL_Class_Type.class_type, TBL_Class_Type.class_type_id)
+            }
+        )
+        subject_cache.update(
+            {
+                row.subject: row.subject_id
+                for row in session.query(TBL_Subject.subject, TBL_Subject.subject_id)
+            }
+        )
+        restriction_type_cache.update(
+            {
+                row.restriction_type: row.restriction_type_id
+                for row in session.query(
+                    TBL_Restriction_Type.restriction_type, TBL_Restriction_Type.restriction_type_id
+                )
+            }
+        )
+        faculty_cache.update(
+            {
+                row.banner_id: row.faculty_id
+                for row in session.query(TBL_Faculty.banner_id, TBL_Faculty.faculty_id)
+            }
+        )
+        term_cache.update(
+            {
+                (row.school_id, row.real_term_id): row.term_id
+                for row in session.query(TBL_Term.school_id, TBL_Term.real_term_id, TBL_Term.term_id)
+            }
+        )
+
+    log_dimension_caches()
+
+
+def log_dimension_caches():
+    log_caches(DIMENSION_CACHES)
+
+    logging.info(f"Cache: {meeting_hash_cache}")
+
+
+def get_class_type_id(value: str):
+    def create():
+        return run_transaction(get_class_type_from_str_no_transaction, value)
+
+    return class_type_cache.get_or_create(value, create)
+
+
+def get_subject_id(subject: str, subject_desc: str):
+    def create():
+        return run_transaction(get_subject_from_str_no_transaction, subject, subject_desc)
+
+    return subject_cache.get_or_create(subject, create)
+
+
+def get_restriction_type_id(value: str):
+    def create():
+        return run_transaction(get_restriction_type_from_str, value)
+
+    return restriction_type_cache.get_or_create(value, create)
+
+
+def get_faculty_ids(faculty: dict[bytes, dict], scrape_id: int):
+    """
+    Returns {banner_id: faculty_id} for the given {banner_id: faculty}, inserting the missing ones
+    """
+
+    def create(missing: list[bytes]):
+        return run_transaction(get_faculty_ids_nt, {i: faculty[i] for i in missing}, scrape_id)
+
+    return faculty_cache.get_or_create_many(faculty.keys(), create)
+
+
+def get_term_id(school_id: int, real_term_id: int):
+    def create():
+        return run_transaction(
+            add_term_no_transaction, school_id, real_term_id, "UNKNOWN AT TIME OF ADDING"
+        )
+
+    return term_cache.get_or_create((int(school_id), int(real_term_id)), create)
+
+
 def get_restriction_type_from_str(value: str, session: SessionObj):
     # Try to find the class_type_id for the given value
     restriction_type_id = (
@@ -155,14 +416,54 @@ def add_terms(school_id: int, term_ids: list[int], term_descriptions: list[str])
     if len(term_ids) != len(term_descriptions):
         raise ValueError("term_ids must be the same length as term_descriptions")
 
-    session: SessionObj
-    with Session().begin() as session:
-        term_ids = [
-            add_term_no_transaction(school_id, term_id, term_description, session)
-            for term_id, term_description in zip(term_ids, term_descriptions)
-        ]
+    ids = run_transaction(add_terms_nt, school_id, term_ids, term_descriptions)
+
+    term_cache.update({(int(school_id), int(i)): j for i, j in zip(term_ids, ids)})
+
+    return ids
+
+
+def add_terms_nt(
+    school_id: int, term_ids: list[int], term_descriptions: list[str], session: SessionObj
+):
+    """
+    Returns the term_id of every real term id in the same order, inserting the missing ones
+    """
+    school_id = int(school_id)
+    real_term_ids = [int(i) for i in term_ids]
+
+    def select():
+        rows = (
+            session.query(TBL_Term.term_id, TBL_Term.real_term_id)
+            .filter(TBL_Term.school_id == school_id)
+            .filter(TBL_Term.real_term_id.in_(set(real_term_ids)))
+            .all()
+        )
+
+        return {row.real_term_id: row.term_id for row in rows}
+
+    with session.no_autoflush:
+        ids = select()
+
+    missing = {}
+    for real_term_id, term_description in zip(real_term_ids, term_descriptions):
+        if real_term_id not in ids:
+            missing.setdefault(
+                real_term_id,
+                {
+                    "real_term_id": real_term_id,
+                    "school_id": school_id,
+                    "term_description": dataUtil.replace_bad_escapes(term_description),
+                },
+            )
+
+    if missing:
+        # the same order every time, so two writers lock the rows in the same order
+        session.bulk_insert_mappings(TBL_Term, [missing[i] for i in sorted(missing)])
 
-        return term_ids
+        ids = select()
+
+    return [ids[i] for i in real_term_ids]
 
 
 def add_term_no_transaction(
@@ -194,34 +495,50 @@ def add_term_no_transaction(
 
 
 def add_courses(term_ids: list[int], course_codes: list[str], course_descriptions: list[str]):
-    ids = []
+    return run_transaction(add_courses_nt, term_ids, course_codes, course_descriptions)
 
-    session: SessionObj
-    with Session().begin() as session:
-        for term_id, course_code, course_description in zip(
-            term_ids, course_codes, course_descriptions
-        ):
-            result = (
-                session.query(TBL_Course)
-                .filter_by(term_id=term_id)
-                .filter_by(course_code=course_code)
-                .first()
-            )
 
-            if not result:
-                result = TBL_Course(
-                    term_id=term_id,
-                    course_code=course_code,
-                    course_description=dataUtil.replace_bad_escapes(course_description),
-                )
+def add_courses_nt(
+    term_ids: list[int], course_codes: list[str], course_descriptions: list[str], session: SessionObj
+):
+    """
+    Returns the course_id of every (term_id, course_code) in the same order, inserting the missing ones
+
+    scrape_and_dump zips the course codes with these ids, so the order has to be kept
+    """
+    keys = list(zip(term_ids, course_codes))
+
+    def select():
+        rows = (
+            session.query(TBL_Course.course_id, TBL_Course.term_id, TBL_Course.course_code)
+            .filter(TBL_Course.term_id.in_(set(term_ids)))
+            .filter(TBL_Course.course_code.in_(set(course_codes)))
+            .all()
+        )
 
-                session.add(result)
+        return {(row.term_id, row.course_code): row.course_id for row in rows}
 
-                session.flush()
+    with session.no_autoflush:
+        ids = select()
+
+    missing = {}
+    for key, course_description in zip(keys, course_descriptions):
+        if key not in ids:
+            missing.setdefault(
+                key,
+                {
+                    "term_id": key[0],
+                    "course_code": key[1],
+                    "course_description": dataUtil.replace_bad_escapes(course_description),
+                },
+            )
 
-            ids.append(result.course_id)
+    if missing:
+        session.bulk_insert_mappings(TBL_Course, [missing[i] for i in sorted(missing)])
 
-    return ids
+        ids = select()
+
+    return [ids[key] for key in keys]
 
 
 def add_course(term_id: int, course_code: str, course_description: str):
@@ -248,12 +565,82 @@ def add_course(term_id: int, course_code: str, course_description: str):
         return result.course_code
 
 
+def get_section_counts(term_id: int) -> dict[str, int]:
+    """
+    Returns how many course datas every course of the term had in the last scrape of the term,
+    by course code
+    """
+    session: SessionObj
+    with Session().begin() as session:
+        return get_section_counts_nt(term_id, session)
+
+
+def get_section_counts_nt(term_id: int, session: SessionObj) -> dict[str, int]:
+    # sections that were dropped stay in the table until --delete-old, they would
+    # make the counts grow every run
+    last_scrape_id = (
+        session.query(func.max(TBL_Course_Data.scrape_id))
+        .join(TBL_Course, TBL_Course_Data.course_id == TBL_Course.course_id)
+        .filter(TBL_Course.term_id == term_id)
+        .scalar()
+    )
+
+    if last_scrape_id is None:
+        return {}
+
+    rows = (
+        session.query(TBL_Course.course_code, func.count(TBL_Course_Data.course_data_id))
+        .join(TBL_Course_Data, TBL_Course_Data.course_id == TBL_Course.course_id)
+        .filter(TBL_Course.term_id == term_id)
+        .filter(TBL_Course_Data.scrape_id == last_scrape_id)
+        .group_by(TBL_Course.course_code)
+        .all()
+    )
+
+    return {course_code: count for course_code, count in rows}
+
+
 def add_course_data(
     school_id: int,
     course_ids: list[int],
     datas: list[dict[str]],
     restrictions: list[dict[str]] = None,
 ):
+    """
+    Writes the course datas, WriteConfig.commit_size sections per transaction
+
+    Every section is set to None in datas once it is committed, so the json it came from
+    can be freed while the rest of the chunk is written
+    """
+    restrictions = check_course_data_args(course_ids, datas, restrictions)
+
+    scrape_id = get_current_scrape()
+
+    size = WriteConfig.commit_size or len(datas)
+
+    for start in range(0, len(datas), max(1, size)):
+        end = start + size
+
+        # committed before the sub batch is written, so a deadlock retry does not redo them
+        batch = prepare_sub_batch(
+            school_id, course_ids[start:end], datas[start:end], restrictions[start:end], scrape_id
+        )
+
+        # every sub batch gets a session of its own, nothing it loaded outlives it
+        waits = run_transaction(get_course_data_writer(), *batch, scrape_id)
+
+        add_released_meetings(waits)
+
+        datas[start:end] = [None] * len(datas[start:end])
+        restrictions[start:end] = [None] * len(restrictions[start:end])
+
+
+def check_course_data_args(
+    course_ids: list[int], datas: list[dict[str]], restrictions: list[dict[str]]
+):
+    """
+    Returns restrictions, a None for every data if it was not given
+    """
     if len(course_ids) != len(datas):
         raise Exception("The length of course_ids must match the length of datas")
 
@@ -263,285 +650,1433 @@ def add_course_data(
     if not restrictions:
         restrictions = [None for i in range(len(course_ids))]
 
-    session: SessionObj
-    with Session().begin() as session:
-        for course_id, data, restriction in zip(course_ids, datas, restrictions):
-            class_type_id = get_class_type_from_str_no_transaction(
-                data["scheduleTypeDescription"], session
-            )
+    return restrictions
 
-            subject_id = get_subject_from_str_no_transaction(
-                data["subject"], dataUtil.replace_bad_escapes(data["subjectDescription"]), session
-            )
 
-            with session.no_autoflush:
-                result = (
-                    session.query(TBL_Course_Data)
-                    .filter_by(course_id=course_id)
-                    .filter_by(crn=data["courseReferenceNumber"])
-                    .first()
-                )
+def get_course_data_writer():
+    if WriteConfig.savepoint_size:
+        return write_course_data_savepoints_nt
 
-            for c in (
-                "campusDescription",
-                "courseTitle",
-                "instructionalMethodDescription",
-            ):
-                data[c] = dataUtil.replace_bad_escapes(data[c])
-
-            if result:
-                with session.no_autoflush:
-                    if (
-                        result.campus_description != data["campusDescription"]
-                        or result.course_title != data["courseTitle"]
-                        or result.delivery != data["instructionalMethodDescription"]
-                        or result.subject_id != subject_id
-                        or result.class_type_id != class_type_id
-                    ):
-                        logging.info(
-                            f"CourseData with course_id={course_id} and crn={data['courseReferenceNumber']} was already in the database! Updating..."
-                        )
-                        result.should_be_indexed = True
-
-                    result.scrape_id = get_current_scrape()
-                    result.subject_id = subject_id
-                    result.crn = data["courseReferenceNumber"]
-                    result.course_title = data["courseTitle"]
-                    result.sequence_number = str(data["sequenceNumber"])
-                    result.campus_description = data["campusDescription"]
-                    result.class_type_id = class_type_id
-                    result.credit_hours = data["creditHours"]
-                    result.maximum_enrollment = data["maximumEnrollment"]
-                    result.current_enrollment = data["enrollment"]
-                    result.maximum_waitlist = data["waitCapacity"]
-                    result.current_waitlist = data["waitCount"]
-                    result.open_section = data["openSection"]
-                    result.link_identifier = data["linkIdentifier"]
-                    result.is_section_linked = data["isSectionLinked"]
-                    result.delivery = data["instructionalMethodDescription"]
-            else:
-                result = TBL_Course_Data(
-                    # course code
-                    course_id=course_id,
-                    scrape_id=get_current_scrape(),
-                    should_be_indexed=True,
-                    #
-                    # crn / course reference number; this should be an int always
-                    crn=data["courseReferenceNumber"],
-                    #
-                    # Biology II
-                    course_title=data["courseTitle"],
-                    subject_id=subject_id,
-                    #
-                    # 001, 002, 003...; should always be int
-                    sequence_number=str(data["sequenceNumber"]),
-                    campus_description=data["campusDescription"],
-                    class_type_id=class_type_id,
-                    #
-                    credit_hours=data["creditHours"],
-                    #
-                    maximum_enrollment=data["maximumEnrollment"],
-                    current_enrollment=data["enrollment"],
-                    #
-                    maximum_waitlist=data["waitCapacity"],
-                    current_waitlist=data["waitCount"],
-                    #
-                    open_section=data["openSection"],
-                    link_identifier=data["linkIdentifier"],
-                    is_section_linked=data["isSectionLinked"],
-                    #
-                    delivery=data["instructionalMethodDescription"],
-                )
-                session.add(result)
-                session.flush()
+    return write_course_data_nt
 
-            course_data_id = result.course_data_id
 
-            for faculty in data["faculty"]:
-                faculty["displayName"] = dataUtil.replace_bad_escapes(faculty["displayName"])
+def add_course_data_nt(
+    school_id: int,
+    course_ids: list[int],
+    datas: list[dict[str]],
+    restrictions: list[dict[str]],
+    session: SessionObj,
+):
+    """
+    Writes a whole chunk of course datas with a handful of set based queries per table,
+    instead of a select and a flush for every section, faculty and meeting
+    """
+    scrape_id = get_current_scrape()
 
-                _ = faculty["displayName"] + (faculty.get("emailAddress", "") or "")
+    dimensions = prepare_course_datas(school_id, datas, restrictions, scrape_id)
 
-                banner_id = dataUtil.sha256_of_str(_)
+    return write_course_data_nt(course_ids, datas, restrictions, dimensions, scrape_id, session)
 
-                if isinstance(banner_id, tuple):
-                    raise Exception("IT IS SOMEHOW A TUPLE?????")
 
-                with session.no_autoflush:
-                    result = session.query(TBL_Faculty).filter_by(banner_id=banner_id).first()
+def write_course_data_nt(
+    course_ids: list[int],
+    datas: list[dict[str]],
+    restrictions: list[dict[str]],
+    dimensions: tuple[dict, dict, dict, dict, dict],
+    scrape_id: int,
+    session: SessionObj,
+):
+    """
+    The writes of add_course_data_nt, dimensions is what prepare_course_datas returned for the datas
 
-                if not result:
-                    result = TBL_Faculty(
-                        banner_id=banner_id,
-                        instructor_name=faculty["displayName"],
-                        instructor_email=faculty["emailAddress"],
-                        instructor_rating=0,
-                        scrape_id=get_current_scrape(),
-                    )
+    Returns the meetings it left to other transactions, see get_meeting_waits
+    """
+    class_type_ids, subject_ids, faculty_ids, term_ids, restriction_type_ids = dimensions
 
-                    session.add(result)
-                    session.flush()
+    course_data_ids, unchanged = upsert_course_data_nt(
+        course_ids, datas, class_type_ids, subject_ids, scrape_id, session
+    )
 
-                faculty_id = result.faculty_id
+    # the faculty and meetings of a section with the same content hash are already in the database
+    changed = [i for i, j in enumerate(unchanged) if not j or restrictions[i]]
 
-                with session.no_autoflush:
-                    result = (
-                        session.query(TBL_Course_Faculty)
-                        .filter_by(course_data_id=course_data_id)
-                        .filter_by(faculty_id=faculty_id)
-                        .first()
-                    )
+    if len(changed) != len(datas):
+        course_ids = [course_ids[i] for i in changed]
+        course_data_ids = [course_data_ids[i] for i in changed]
+        datas = [datas[i] for i in changed]
+        restrictions = [restrictions[i] for i in changed]
 
-                if not result:
-                    result = TBL_Course_Faculty(
-                        course_data_id=course_data_id, faculty_id=faculty_id
-                    )
+    add_course_faculty_nt(course_data_ids, datas, faculty_ids, session)
 
-                    session.add(result)
+    add_meetings_nt(course_ids, course_data_ids, datas, term_ids, scrape_id, session)
 
-            # session.flush()
+    for course_data_id, restriction in zip(course_data_ids, restrictions):
+        if restriction:
+            add_restriction_nt(course_data_id, restriction, restriction_type_ids, session)
 
-            for meeting in data["meetingsFaculty"]:
-                useful_data = meeting["meetingTime"]
+    session.flush()
 
-                crn = useful_data["courseReferenceNumber"]
-                real_term_id = dataUtil.parse_int(useful_data["term"])
-                if real_term_id == -1:
-                    logging.warning(
-                        f"Got bad term_id of {useful_data['term']} course_id={course_id} for meeting {meeting}"
-                    )
-                    continue
+    return get_meeting_waits(session)
 
-                term_id = add_term_no_transaction(
-                    school_id, real_term_id, "UNKNOWN AT TIME OF ADDING", session
-                )
 
-                start_date = dataUtil.parse_date(useful_data["startDate"])
-                end_date = dataUtil.parse_date(useful_data["endDate"])
-
-                if start_date == end_date:
-                    time_delta_days = 0
-                else:
-                    time_delta_days = 7
-
-                to_insert = TBL_Meeting(
-                    meeting_hash=b"",
-                    scrape_id=get_current_scrape(),
-                    course_data_id=course_data_id,
-                    crn=crn,
-                    term_id=term_id,
-                    time_delta=time_delta_days,
-                    building=dataUtil.replace_bad_escapes(useful_data["building"]),
-                    building_description=dataUtil.replace_bad_escapes(
-                        useful_data["buildingDescription"]
-                    ),
-                    meeting_type=useful_data["meetingType"],
-                    meeting_type_description=useful_data["meetingTypeDescription"],
-                    start_date=start_date,
-                    end_date=end_date,
-                    begin_time=useful_data["beginTime"],
-                    end_time=useful_data["endTime"],
-                    days_of_week=py_core_general.encode_days_of_week(useful_data),
-                    room=useful_data["room"],
-                    category=useful_data["category"],
-                    credit_hour_session=useful_data["creditHourSession"],
-                    hours_week=useful_data["hoursWeek"],
-                    meeting_schedule_type=useful_data["meetingScheduleType"],
-                )
+def write_course_data_savepoints_nt(
+    course_ids: list[int],
+    datas: list[dict[str]],
+    restrictions: list[dict[str]],
+    dimensions: tuple[dict, dict, dict, dict, dict],
+    scrape_id: int,
+    session: SessionObj,
+):
+    """
+    write_course_data_nt with a savepoint around every WriteConfig.savepoint_size sections,
+    so a bad section is skipped instead of rolling back everything else
+    """
+    size = WriteConfig.savepoint_size
 
-                # we need to make our own unique identifier for the meeting
-                # so this is it, just all the data i figured was important
-                meeting_hash = dataUtil.sha256_of_str(
-                    f"{crn}{term_id}{to_insert.building}{to_insert.meeting_type}"
-                    f"{to_insert.start_date}{to_insert.end_date}{to_insert.begin_time}{to_insert.end_time}"
-                    f"{to_insert.days_of_week}{to_insert.room}"
-                )
+    for start in range(0, len(datas), size):
+        group = list(range(start, min(start + size, len(datas))))
 
-                to_insert.meeting_hash = meeting_hash
+        args = (course_ids, datas, restrictions, dimensions, scrape_id, session)
 
-                with session.no_autoflush:
-                    result = session.query(TBL_Meeting).filter_by(meeting_hash=meeting_hash).first()
+        if write_savepoint_nt(group, *args) or len(group) == 1:
+            continue
 
-                if not result:
-                    session.add(to_insert)
-                    session.flush()
+        # find the ones that broke it, the rest of the group still gets written
+        for i in group:
+            write_savepoint_nt([i], *args)
 
-            if restriction:
-                add_restriction_nt(course_data_id, restriction, session)
+    return get_meeting_waits(session)
 
-        session.flush()
 
+def write_savepoint_nt(
+    indexes: list[int],
+    course_ids: list[int],
+    datas: list[dict[str]],
+    restrictions: list[dict[str]],
+    dimensions: tuple[dict, dict, dict, dict, dict],
+    scrape_id: int,
+    session: SessionObj,
+):
+    """
+    Writes the datas at the indexes in a savepoint, returns False if it was rolled back
+    """
+    claimed = len(get_meeting_claims(session))
+
+    try:
+        with session.begin_nested():
+            write_course_data_nt(
+                [course_ids[i] for i in indexes],
+                [datas[i] for i in indexes],
+                [restrictions[i] for i in indexes],
+                dimensions,
+                scrape_id,
+                session,
+            )
+
+        return True
 
-def add_restriction_nt(
-    course_data_id: int, restriction: dict[str, list[dict[str, bool]]], session: SessionObj
+    except Exception as e:
+        # mysql rolled back the whole transaction, not just the savepoint, skipping the section
+        # would carry on writing into a transaction that is gone. run_transaction runs it again
+        if is_retryable(e):
+            raise
+
+        release_meeting_claims(session, claimed)
+
+        if len(indexes) > 1:
+            logging.warning(f"Could not write {len(indexes)} sections, writing them one at a time")
+            metrics.increment("course_data.savepoint_rollbacks")
+
+            return False
+
+        skip_section(course_ids[indexes[0]], datas[indexes[0]], e)
+
+        return False
+
+
+_lock = threading.Lock()
+
+# the course_id of every section that was skipped, the terms of these courses keep their old data
+_skipped_course_ids: set[int] = set()
+
+
+def skip_section(course_id: int, data: dict[str], e: Exception):
+    """
+    Logs a section that could not be written and remembers its course,
+    so delete_old_data does not delete the section's old row of a term that still counts as complete
+    """
+    logging.error(
+        f"Skipping course data with course_id={course_id} and crn={data.get('courseReferenceNumber')}"
+    )
+    logging.error(e)
+    metrics.increment("course_data.skipped")
+
+    with _lock:
+        _skipped_course_ids.add(course_id)
+
+
+def get_skipped_term_ids_nt(session: SessionObj):
+    """
+    The term_id of every term a section was skipped in
+    """
+    with _lock:
+        course_ids = set(_skipped_course_ids)
+
+    if not course_ids:
+        return set()
+
+    rows = session.query(TBL_Course.term_id).filter(TBL_Course.course_id.in_(course_ids)).distinct()
+
+    return {row.term_id for row in rows}
+
+
+def prepare_course_datas(
+    school_id: int,
+    datas: list[dict[str]],
+    restrictions: list[dict[str]],
+    scrape_id: int,
+    skipped: list[tuple[int, Exception]] = None,
 ):
-    for key, value in restriction.items():
-        restriction_type_id = get_restriction_type_from_str(key, session)
+    """
+    Cleans up the text of the datas and returns the ids of their class types, subjects,
+    faculty, the terms of their meetings and their restriction types
 
-        for rest in value:
-            rest["value"] = dataUtil.replace_bad_escapes(rest["value"])
+    These come from the process wide caches, a miss is inserted and committed on its own,
+    so this has to happen before the caller's transaction writes anything. They are resolved
+    in sorted order, so writers that miss the same values at once lock them in the same order
 
-            result = session.query(TBL_Restriction).filter_by(restriction=rest["value"]).first()
+    A section that can not be prepared raises, unless skipped is given, then its (index, error)
+    is added to it and the rest are still prepared
+    """
+    class_types = set()
+    subject_descs = {}
+    faculty = {}
+    real_term_ids = set()
+    restriction_types = set()
 
-            if not result:
-                result = TBL_Restriction(
-                    restriction=rest["value"],
-                    must_be_in=rest["must_be_in"],
-                    restriction_type=restriction_type_id,
-                )
+    for index, data in enumerate(datas):
+        restriction = restrictions[index] if restrictions else None
 
-                session.add(result)
-                session.flush()
+        try:
+            keys = get_section_keys(data, restriction)
 
-            mapping = (
-                session.query(TBL_Course_Restriction)
-                .filter_by(restriction_id=result.restriction_id)
-                .filter_by(course_data_id=course_data_id)
-                .first()
-            )
+        except Exception as e:
+            if skipped is None:
+                raise
 
-            if not mapping:
-                mapping = TBL_Course_Restriction(
-                    restriction_id=result.restriction_id, course_data_id=course_data_id
-                )
-                session.add(mapping)
-                session.flush()
+            skipped.append((index, e))
+            continue
 
+        class_type, subject, subject_desc, section_faculty, section_terms, section_types = keys
 
+        class_types.add(class_type)
+        subject_descs.setdefault(subject, subject_desc)
+        real_term_ids.update(section_terms)
+        restriction_types.update(section_types)
 
+        for banner_id, i in section_faculty.items():
+            faculty.setdefault(banner_id, i)
 
-def delete_old_data(school_id: int):
-    
-    if not school_id or school_id < 1:
-        raise Exception("School value must be non-null and greator than 0")
-    
-    logging.info(f"Preparing to delete old data for {school_id}")
+    class_type_ids = {value: get_class_type_id(value) for value in sorted(class_types, key=str)}
 
-    session: SessionObj
+    subject_ids = {
+        subject: get_subject_id(subject, dataUtil.replace_bad_escapes(subject_descs[subject]))
+        for subject in sorted(subject_descs, key=str)
+    }
+
+    faculty_ids = get_faculty_ids(faculty, scrape_id)
+
+    restriction_type_ids = {
+        key: get_restriction_type_id(key) for key in sorted(restriction_types, key=str)
+    }
+
+    real_term_ids.discard(-1)
+
+    term_ids = {i: get_term_id(school_id, i) for i in sorted(real_term_ids)}
+
+    return class_type_ids, subject_ids, faculty_ids, term_ids, restriction_type_ids
+
+
+def get_section_keys(data: dict[str], restriction: dict[str]):
+    """
+    Cleans up the text of a section and returns what prepare_course_datas needs from it,
+    raises if it is missing any of that
+    """
+    for c in (
+        "campusDescription",
+        "courseTitle",
+        "instructionalMethodDescription",
+    ):
+        data[c] = dataUtil.replace_bad_escapes(data[c])
+
+    faculty = get_faculty_by_banner_id([data])
+
+    real_term_ids = {
+        dataUtil.parse_int(meeting["meetingTime"]["term"]) for meeting in data["meetingsFaculty"]
+    }
+
+    return (
+        data["scheduleTypeDescription"],
+        data["subject"],
+        data["subjectDescription"],
+        faculty,
+        real_term_ids,
+        set(restriction or ()),
+    )
+
+
+def prepare_sub_batch(
+    school_id: int,
+    course_ids: list[int],
+    datas: list[dict[str]],
+    restrictions: list[dict[str]],
+    scrape_id: int,
+):
+    """
+    prepare_course_datas for a sub batch of add_course_data, returns the course_ids, datas,
+    restrictions and dimensions that are left to write
+
+    With savepoints a section that can not be prepared is skipped, the same as one that can not be written
+    """
+    skipped = [] if WriteConfig.savepoint_size else None
+
+    dimensions = prepare_course_datas(school_id, datas, restrictions, scrape_id, skipped)
+
+    if not skipped:
+        return course_ids, datas, restrictions, dimensions
+
+    for index, e in skipped:
+        skip_section(course_ids[index], datas[index], e)
+
+    skipped_indexes = {index for index, _ in skipped}
+    keep = [i for i in range(len(datas)) if i not in skipped_indexes]
+
+    return (
+        [course_ids[i] for i in keep],
+        [datas[i] for i in keep],
+        [restrictions[i] for i in keep],
+        dimensions,
+    )
+
+
+# the fields of a section that change all the time, they are written on their own narrow update
+
+
+ENROLLMENT_FIELDS = {
+    "maximum_enrollment": "maximumEnrollment",
+    "current_enrollment": "enrollment",
+    "maximum_waitlist": "waitCapacity",
+    "current_waitlist": "waitCount",
+    "open_section": "openSection",
+}
+
+# json fields that are left out of the content hash, the enrollment ones and what is derived from them
+UNHASHED_FIELDS = set(ENROLLMENT_FIELDS.values()) | {"seatsAvailable", "waitAvailable"}
+
+# unchanged sections only skip their faculty and meetings once py_core's TBL_Course_Data has a
+# content_hash column (a BINARY(32), added by a py_core migration). py_core does not have it yet,
+# so this is off and only the section row itself is skipped. Nothing else changes when it is missing
+HAS_CONTENT_HASH = hasattr(TBL_Course_Data, "content_hash")
+
+
+def get_content_hash(data: dict[str]):
+    """
+    A stable hash of everything about a section except its enrollment, including its faculty and meetings
+    """
+    content = {k: v for k, v in data.items() if k not in UNHASHED_FIELDS}
+
+    return dataUtil.sha256_of_str(json.dumps(content, sort_keys=True, default=str))
+
+
+def get_course_data_values(data: dict[str], subject_id: int, class_type_id: int, scrape_id: int):
+    """
+    The columns of a course data that are not its enrollment, course_id or content hash
+    """
+    return {
+        "scrape_id": scrape_id,
+        "subject_id": subject_id,
+        "crn": data["courseReferenceNumber"],
+        "course_title": data["courseTitle"],
+        "sequence_number": str(data["sequenceNumber"]),
+        "campus_description": data["campusDescription"],
+        "class_type_id": class_type_id,
+        "credit_hours": data["creditHours"],
+        "link_identifier": data["linkIdentifier"],
+        "is_section_linked": data["isSectionLinked"],
+        "delivery": data["instructionalMethodDescription"],
+    }
+
+
+def get_course_data_ids_nt(course_ids: list[int], crns: list[str], session: SessionObj):
+    """
+    Returns {(course_id, crn): course_data_id} for the rows that exist, in a single query
+    """
+    rows = (
+        session.query(
+            TBL_Course_Data.course_data_id, TBL_Course_Data.course_id, TBL_Course_Data.crn
+        )
+        .filter(TBL_Course_Data.course_id.in_(set(course_ids)))
+        .filter(TBL_Course_Data.crn.in_(set(crns)))
+        .all()
+    )
+
+    return {(row.course_id, str(row.crn)): row.course_data_id for row in rows}
+
+
+def upsert_course_data_nt(
+    course_ids: list[int],
+    datas: list[dict[str]],
+    class_type_ids: dict[str, int],
+    subject_ids: dict[str, int],
+    scrape_id: int,
+    session: SessionObj,
+):
+    """
+    Inserts or updates a course data for every data
+
+    Returns their course_data_id in the same order, and if each of them is known to be exactly
+    what is in the database already, so its faculty and meetings do not have to be written again
+    """
+    keys = [(course_id, str(data["courseReferenceNumber"])) for course_id, data in zip(course_ids, datas)]
+
+    columns = [
+        TBL_Course_Data.course_data_id,
+        TBL_Course_Data.course_id,
+        TBL_Course_Data.crn,
+        TBL_Course_Data.subject_id,
+        TBL_Course_Data.course_title,
+        TBL_Course_Data.sequence_number,
+        TBL_Course_Data.campus_description,
+        TBL_Course_Data.class_type_id,
+        TBL_Course_Data.credit_hours,
+        TBL_Course_Data.link_identifier,
+        TBL_Course_Data.is_section_linked,
+        TBL_Course_Data.delivery,
+        TBL_Course_Data.maximum_enrollment,
+        TBL_Course_Data.current_enrollment,
+        TBL_Course_Data.maximum_waitlist,
+        TBL_Course_Data.current_waitlist,
+        TBL_Course_Data.open_section,
+    ]
+
+    if HAS_CONTENT_HASH:
+        columns.append(TBL_Course_Data.content_hash)
+
+    with session.no_autoflush:
+        rows = (
+            session.query(*columns)
+            .filter(TBL_Course_Data.course_id.in_({i[0] for i in keys}))
+            .filter(TBL_Course_Data.crn.in_({i[1] for i in keys}))
+            .all()
+        )
+
+    existing = {(row.course_id, str(row.crn)): row for row in rows}
+
+    to_insert = {}
+    to_update = {}
+    to_update_enrollment = {}
+    to_touch = {}
+    unchanged = set()
+
+    for key, course_id, data in zip(keys, course_ids, datas):
+        subject_id = subject_ids[data["subject"]]
+        class_type_id = class_type_ids[data["scheduleTypeDescription"]]
+
+        values = get_course_data_values(data, subject_id, class_type_id, scrape_id)
+
+        enrollment = {column: data[field] for column, field in ENROLLMENT_FIELDS.items()}
+
+        content_hash = get_content_hash(data) if HAS_CONTENT_HASH else None
+
+        result = existing.get(key, None)
+
+        if result is None:
+            values.update(enrollment)
+            values["course_id"] = course_id
+            values["should_be_indexed"] = True
+
+            if HAS_CONTENT_HASH:
+                values["content_hash"] = content_hash
+
+            to_insert[key] = values
+            continue
+
+        course_data_id = result.course_data_id
+
+        # crn is part of the key and is matched as a string already
+        same_content = all(
+            getattr(result, column) == value
+            for column, value in values.items()
+            if column not in ("scrape_id", "crn")
+        )
+
+        if same_content and HAS_CONTENT_HASH and result.content_hash == content_hash:
+            unchanged.add(key)
+
+        if same_content:
+            # the faculty or meetings changed, the hash has to follow them
+            stale_hash = HAS_CONTENT_HASH and result.content_hash != content_hash
+
+            if not stale_hash and all(
+                getattr(result, column) == value for column, value in enrollment.items()
+            ):
+                to_touch[key] = course_data_id
+
+            else:
+                enrollment["course_data_id"] = course_data_id
+                enrollment["scrape_id"] = scrape_id
+
+                if stale_hash:
+                    enrollment["content_hash"] = content_hash
+
+                to_update_enrollment[key] = enrollment
+
+            continue
+
+        values.update(enrollment)
+        values["course_data_id"] = course_data_id
+
+        if HAS_CONTENT_HASH:
+            values["content_hash"] = content_hash
+
+        if (
+            result.campus_description != data["campusDescription"]
+            or result.course_title != data["courseTitle"]
+            or result.delivery != data["instructionalMethodDescription"]
+            or result.subject_id != subject_id
+            or result.class_type_id != class_type_id
+        ):
+            logging.info(
+                f"CourseData with course_id={course_id} and crn={data['courseReferenceNumber']} was already in the database! Updating..."
+            )
+            values["should_be_indexed"] = True
+
+        to_update[key] = values
+
+    if to_touch:
+        # nothing changed, only mark it as seen by this scrape
+        session.query(TBL_Course_Data).filter(
+            TBL_Course_Data.course_data_id.in_(to_touch.values())
+        ).update({TBL_Course_Data.scrape_id: scrape_id}, synchronize_session=False)
+
+    if to_update_enrollment:
+        session.bulk_update_mappings(TBL_Course_Data, list(to_update_enrollment.values()))
+
+    if to_update:
+        session.bulk_update_mappings(TBL_Course_Data, list(to_update.values()))
+
+    metrics.increment("course_data.inserted", len(to_insert))
+    metrics.increment("course_data.updated", len(to_update))
+    metrics.increment("course_data.enrollment_updated", len(to_update_enrollment))
+    metrics.increment("course_data.touched", len(to_touch))
+
+    course_data_ids = {key: row.course_data_id for key, row in existing.items()}
+
+    if to_insert:
+        session.bulk_insert_mappings(TBL_Course_Data, list(to_insert.values()))
+
+        # mysql can not return the ids of a multi row insert, so read them back
+        course_data_ids.update(
+            get_course_data_ids_nt(
+                [i[0] for i in to_insert], [i[1] for i in to_insert], session
+            )
+        )
+
+    return [course_data_ids[key] for key in keys], [key in unchanged for key in keys]
+
+
+def get_faculty_ids_nt(faculty: dict[bytes, dict], scrape_id: int, session: SessionObj):
+    """
+    Returns {banner_id: faculty_id} for the given {banner_id: faculty}, inserting the missing ones
+    """
+    if not faculty:
+        return {}
+
+    def select():
+        rows = (
+            session.query(TBL_Faculty.faculty_id, TBL_Faculty.banner_id)
+            .filter(TBL_Faculty.banner_id.in_(faculty.keys()))
+            .all()
+        )
+
+        return {row.banner_id: row.faculty_id for row in rows}
+
+    faculty_ids = select()
+
+    missing = [
+        {
+            "banner_id": banner_id,
+            "instructor_name": faculty[banner_id]["displayName"],
+            "instructor_email": faculty[banner_id]["emailAddress"],
+            "instructor_rating": 0,
+            "scrape_id": scrape_id,
+        }
+        for banner_id in sorted(faculty)
+        if banner_id not in faculty_ids
+    ]
+
+    if missing:
+        session.bulk_insert_mappings(TBL_Faculty, missing)
+
+        faculty_ids = select()
+
+    return faculty_ids
+
+
+def get_faculty_banner_id(faculty: dict):
+    _ = faculty["displayName"] + (faculty.get("emailAddress", "") or "")
+
+    return dataUtil.sha256_of_str(_)
+
+
+def get_faculty_by_banner_id(datas: list[dict[str]]):
+    """
+    Returns {banner_id: faculty} of every faculty in the datas
+    """
+    faculty = {}
+
+    for data in datas:
+        for i in data["faculty"]:
+            i["displayName"] = dataUtil.replace_bad_escapes(i["displayName"])
+
+            faculty.setdefault(get_faculty_banner_id(i), i)
+
+    return faculty
+
+
+def add_course_faculty_nt(
+    course_data_ids: list[int],
+    datas: list[dict[str]],
+    faculty_ids: dict[bytes, int],
+    session: SessionObj,
+):
+    links = {}
+
+    for course_data_id, data in zip(course_data_ids, datas):
+        for i in data["faculty"]:
+            links[(course_data_id, faculty_ids[get_faculty_banner_id(i)])] = None
+
+    if not links:
+        return
+
+    existing = set(
+        session.query(TBL_Course_Faculty.course_data_id, TBL_Course_Faculty.faculty_id)
+        .filter(TBL_Course_Faculty.course_data_id.in_(set(course_data_ids)))
+        .all()
+    )
+
+    missing = [
+        {"course_data_id": course_data_id, "faculty_id": faculty_id}
+        for course_data_id, faculty_id in links
+        if (course_data_id, faculty_id) not in existing
+    ]
+
+    if missing:
+        session.bulk_insert_mappings(TBL_Course_Faculty, missing)
+
+
+def get_meeting_hash(meeting: dict):
+    # we need to make our own unique identifier for the meeting
+    # so this is it, just all the data i figured was important
+    return dataUtil.sha256_of_str(
+        f"{meeting['crn']}{meeting['term_id']}{meeting['building']}{meeting['meeting_type']}"
+        f"{meeting['start_date']}{meeting['end_date']}{meeting['begin_time']}{meeting['end_time']}"
+        f"{meeting['days_of_week']}{meeting['room']}"
+    )
+
+
+def get_meeting_values(useful_data: dict, term_id: int, scrape_id: int):
+    """
+    The columns of a meeting from its meetingTime, everything but its course_data_id
+    """
+    start_date = dataUtil.parse_date(useful_data["startDate"])
+    end_date = dataUtil.parse_date(useful_data["endDate"])
+
+    if start_date == end_date:
+        time_delta_days = 0
+    else:
+        time_delta_days = 7
+
+    values = {
+        "scrape_id": scrape_id,
+        "crn": useful_data["courseReferenceNumber"],
+        "term_id": term_id,
+        "time_delta": time_delta_days,
+        "building": dataUtil.replace_bad_escapes(useful_data["building"]),
+        "building_description": dataUtil.replace_bad_escapes(useful_data["buildingDescription"]),
+        "meeting_type": useful_data["meetingType"],
+        "meeting_type_description": useful_data["meetingTypeDescription"],
+        "start_date": start_date,
+        "end_date": end_date,
+        "begin_time": useful_data["beginTime"],
+        "end_time": useful_data["endTime"],
+        "days_of_week": py_core_general.encode_days_of_week(useful_data),
+        "room": useful_data["room"],
+        "category": useful_data["category"],
+        "credit_hour_session": useful_data["creditHourSession"],
+        "hours_week": useful_data["hoursWeek"],
+        "meeting_schedule_type": useful_data["meetingScheduleType"],
+    }
+
+    values["meeting_hash"] = get_meeting_hash(values)
+
+    return values
+
+
+# where a session keeps the meeting hashes it claimed and has not committed yet
+MEETING_CLAIMS = "meeting_claims"
+
+# where a session keeps the meetings it left to other transactions once it committed
+MEETING_WAITS = "meeting_waits"
+
+
+def get_meeting_claims(
+    session: SessionObj,
+) -> list[tuple[int, list[bytes], list[tuple[KeyClaim, dict]]]]:
+    """
+    The (term_id, meeting hashes, waits) the session claimed in meeting_hash_cache in its transaction,
+    waits has the (claim, meeting) of every meeting another transaction had claimed first
+
+    The hashes are confirmed when the transaction commits and the waits move to get_meeting_waits.
+    They are released if the transaction rolls back, so the meetings are inserted by the next one.
+    A savepoint that rolls back has to release what it claimed itself, see release_meeting_claims
+    """
+    claims = session.info.get(MEETING_CLAIMS, None)
+
+    if claims is not None:
+        return claims
+
+    claims = session.info[MEETING_CLAIMS] = []
+
+    def release(session: SessionObj):
+        if not session.in_nested_transaction():
+            release_meeting_claims(session, 0)
+
+    def confirm(session: SessionObj):
+        if session.in_nested_transaction():
+            return
+
+        waits = get_meeting_waits(session)
+
+        for term_id, hashes, waiting in claims:
+            meeting_hash_cache.confirm(term_id, hashes)
+            waits.extend(waiting)
+
+        claims.clear()
+
+    event.listen(session, "after_rollback", release)
+    event.listen(session, "after_commit", confirm)
+
+    return claims
+
+
+def get_meeting_waits(session: SessionObj) -> list[tuple[KeyClaim, dict]]:
+    """
+    The (claim, meeting) of the meetings the session skipped because another transaction
+    had claimed them, only filled in once the session committed, see add_released_meetings
+    """
+    return session.info.setdefault(MEETING_WAITS, [])
+
+
+def release_meeting_claims(session: SessionObj, start: int):
+    """
+    Releases the meeting hashes the session claimed after it had start claims
+    """
+    claims = get_meeting_claims(session)
+
+    for term_id, hashes, _ in claims[start:]:
+        meeting_hash_cache.release(term_id, hashes)
+
+    del claims[start:]
+
+
+def get_released_meetings(waits: list[tuple[KeyClaim, dict]]):
+    """
+    Waits for the transactions that claimed the meetings first, returns the meetings
+    they rolled back and that still have to be inserted
+    """
+    return [meeting for claim, meeting in waits if meeting_hash_cache.wait(claim)]
+
+
+def add_released_meetings(waits: list[tuple[KeyClaim, dict]]):
+    """
+    Inserts the meetings a committed transaction skipped because another one had claimed them,
+    if that one rolled back after all
+    """
+    while waits:
+        meetings = get_released_meetings(waits)
+
+        if not meetings:
+            return
+
+        metrics.increment("meeting.released_inserts", len(meetings))
+
+        waits = run_transaction(insert_meetings_nt, meetings)
+
+
+def get_meeting_hashes_nt(term_id: int, session: SessionObj):
+    return [
+        row.meeting_hash
+        for row in session.query(TBL_Meeting.meeting_hash).filter(TBL_Meeting.term_id == term_id)
+    ]
+
+
+def preload_meeting_hashes(term_ids: Iterable[int]):
+    """
+    Loads the meeting hashes of the terms that are not in meeting_hash_cache yet with the sync engine
+    """
+    session: SessionObj
+    with Session().begin() as session:
+
+        def load(term_id: int):
+            return get_meeting_hashes_nt(term_id, session)
+
+        for term_id in sorted(set(term_ids)):
+            meeting_hash_cache.preload(term_id, load)
+
+
+def add_meetings_nt(
+    course_ids: list[int],
+    course_data_ids: list[int],
+    datas: list[dict[str]],
+    term_ids: dict[int, int],
+    scrape_id: int,
+    session: SessionObj,
+):
+    """
+    term_ids has the term_id of every real term id the meetings are in
+    """
+    meetings = {}
+
+    for course_id, course_data_id, data in zip(course_ids, course_data_ids, datas):
+        for meeting in data["meetingsFaculty"]:
+            useful_data = meeting["meetingTime"]
+
+            real_term_id = dataUtil.parse_int(useful_data["term"])
+            if real_term_id == -1:
+                logging.warning(
+                    f"Got bad term_id of {useful_data['term']} course_id={course_id} for meeting {meeting}"
+                )
+                continue
+
+            to_insert = get_meeting_values(useful_data, term_ids[real_term_id], scrape_id)
+            to_insert["course_data_id"] = course_data_id
+
+            # the first one wins, like it did when every meeting was checked against the table
+            meetings.setdefault(to_insert["meeting_hash"], to_insert)
+
+    if meetings:
+        insert_meetings_nt(list(meetings.values()), session)
+
+
+def insert_meetings_nt(meetings: list[dict], session: SessionObj):
+    """
+    Inserts the meetings that are not in the database yet, returns the meetings the session
+    left to other transactions, see get_meeting_waits
+    """
+
+    def load(term_id: int):
+        return get_meeting_hashes_nt(term_id, session)
+
+    by_term: dict[int, dict[bytes, dict]] = {}
+
+    for meeting in meetings:
+        by_term.setdefault(meeting["term_id"], {})[meeting["meeting_hash"]] = meeting
+
+    claims = get_meeting_claims(session)
+    missing = []
+
+    for term_id, by_hash in by_term.items():
+        # the claims list is only used by this session, it tells its claims apart from the others
+        claimed, waiting = meeting_hash_cache.claim(term_id, list(by_hash), load, claims)
+
+        claims.append((term_id, claimed, [(claim, by_hash[i]) for i, claim in waiting]))
+
+        missing.extend(by_hash[i] for i in claimed)
+
+    if missing:
+        session.bulk_insert_mappings(TBL_Meeting, missing)
+
+    return get_meeting_waits(session)
+
+
+def add_restriction_nt(
+    course_data_id: int,
+    restriction: dict[str, list[dict[str, bool]]],
+    restriction_type_ids: dict[str, int],
+    session: SessionObj,
+):
+    """
+    restriction_type_ids has the id of every restriction type, from prepare_course_datas
+    """
+    for key, value in restriction.items():
+        restriction_type_id = restriction_type_ids[key]
+
+        for rest in value:
+            rest["value"] = dataUtil.replace_bad_escapes(rest["value"])
+
+            result = session.query(TBL_Restriction).filter_by(restriction=rest["value"]).first()
+
+            if not result:
+                result = TBL_Restriction(
+                    restriction=rest["value"],
+                    must_be_in=rest["must_be_in"],
+                    restriction_type=restriction_type_id,
+                )
+
+                session.add(result)
+                session.flush()
+
+            mapping = (
+                session.query(TBL_Course_Restriction)
+                .filter_by(restriction_id=result.restriction_id)
+                .filter_by(course_data_id=course_data_id)
+                .first()
+            )
+
+            if not mapping:
+                mapping = TBL_Course_Restriction(
+                    restriction_id=result.restriction_id, course_data_id=course_data_id
+                )
+                session.add(mapping)
+                session.flush()
+
+
+
+
+# the columns of a course data and a meeting that are staged by a TermLoad, course_data_id
+# is found by the merge
+COURSE_DATA_MERGE_COLUMNS = [
+    "course_id",
+    "scrape_id",
+    "subject_id",
+    "crn",
+    "course_title",
+    "sequence_number",
+    "campus_description",
+    "class_type_id",
+    "credit_hours",
+    "link_identifier",
+    "is_section_linked",
+    "delivery",
+    *ENROLLMENT_FIELDS,
+] + (["content_hash"] if HAS_CONTENT_HASH else [])
+
+MEETING_MERGE_COLUMNS = [
+    "meeting_hash",
+    "scrape_id",
+    "crn",
+    "term_id",
+    "time_delta",
+    "building",
+    "building_description",
+    "meeting_type",
+    "meeting_type_description",
+    "start_date",
+    "end_date",
+    "begin_time",
+    "end_time",
+    "days_of_week",
+    "room",
+    "category",
+    "credit_hour_session",
+    "hours_week",
+    "meeting_schedule_type",
+]
+
+# a course data changing any of these has to be indexed again
+REINDEX_COLUMNS = ["campus_description", "course_title", "delivery", "subject_id", "class_type_id"]
+
+
+_stage_metadata = MetaData()
+
+
+def _stage_table(name: str, columns: dict[str, Column]):
+    # no keys or indexes, they are only ever scanned once by the merge
+    return Table(
+        name,
+        _stage_metadata,
+        *(Column(column, source.type) for column, source in columns.items()),
+        prefixes=["TEMPORARY"],
+    )
+
+
+STAGE_COURSE_DATA = _stage_table(
+    "stage_course_data", {i: TBL_Course_Data.__table__.c[i] for i in COURSE_DATA_MERGE_COLUMNS}
+)
+
+STAGE_COURSE_FACULTY = _stage_table(
+    "stage_course_faculty",
+    {
+        "course_id": TBL_Course_Data.__table__.c.course_id,
+        "crn": TBL_Course_Data.__table__.c.crn,
+        "faculty_id": TBL_Course_Faculty.__table__.c.faculty_id,
+    },
+)
+
+STAGE_MEETING = _stage_table(
+    "stage_meeting",
+    {
+        **{i: TBL_Meeting.__table__.c[i] for i in MEETING_MERGE_COLUMNS},
+        # the section the meeting belongs to
+        "course_id": TBL_Course_Data.__table__.c.course_id,
+        "section_crn": TBL_Course_Data.__table__.c.crn,
+    },
+)
+
+STAGE_TABLES = (STAGE_COURSE_DATA, STAGE_COURSE_FACULTY, STAGE_MEETING)
+
+
+class TermLoad:
+    """
+    The sections, faculty links and meetings of a whole term, collected as the term is scraped
+    and written all at once by merge_term
+
+    Only the rows are kept, not the json they were made from
+    """
+
+    def __init__(self, school_id: int) -> None:
+        self.school_id = school_id
+        self.scrape_id = get_current_scrape()
+
+        self.course_datas: dict[tuple[int, str], dict] = {}
+        self.course_faculty: dict[tuple[int, str, int], None] = {}
+        self.meetings: dict[tuple[int, bytes], dict] = {}
+
+    def __repr__(self) -> str:
+        return (
+            f"<TermLoad school={self.school_id} course_datas={len(self.course_datas)} "
+            f"course_faculty={len(self.course_faculty)} meetings={len(self.meetings)}>"
+        )
+
+    def add(self, course_ids: list[int], datas: list[dict[str]]):
+        if len(course_ids) != len(datas):
+            raise Exception("The length of course_ids must match the length of datas")
+
+        class_type_ids, subject_ids, faculty_ids, term_ids, _ = prepare_course_datas(
+            self.school_id, datas, None, self.scrape_id
+        )
+
+        for course_id, data in zip(course_ids, datas):
+            crn = str(data["courseReferenceNumber"])
+
+            values = get_course_data_values(
+                data,
+                subject_ids[data["subject"]],
+                class_type_ids[data["scheduleTypeDescription"]],
+                self.scrape_id,
+            )
+            values.update({column: data[field] for column, field in ENROLLMENT_FIELDS.items()})
+            values["course_id"] = course_id
+
+            if HAS_CONTENT_HASH:
+                values["content_hash"] = get_content_hash(data)
+
+            self.course_datas[(course_id, crn)] = values
+
+            for i in data["faculty"]:
+                faculty_id = faculty_ids[get_faculty_banner_id(i)]
+
+                self.course_faculty[(course_id, crn, faculty_id)] = None
+
+            for meeting in data["meetingsFaculty"]:
+                useful_data = meeting["meetingTime"]
+
+                real_term_id = dataUtil.parse_int(useful_data["term"])
+                if real_term_id == -1:
+                    logging.warning(
+                        f"Got bad term_id of {useful_data['term']} course_id={course_id} for meeting {meeting}"
+                    )
+                    continue
+
+                values = get_meeting_values(useful_data, term_ids[real_term_id], self.scrape_id)
+                values["course_id"] = course_id
+                values["section_crn"] = crn
+
+                # the first one wins, like it does when written a chunk at a time
+                self.meetings.setdefault((values["term_id"], values["meeting_hash"]), values)
+
+
+def merge_term(load: TermLoad):
+    run_transaction(merge_term_nt, load)
+
+
+def drop_stage_tables_nt(session: SessionObj):
+    connection = session.connection()
+
+    # a plain DROP TABLE would commit the transaction on mysql
+    temporary = "TEMPORARY " if connection.dialect.name in ("mysql", "mariadb") else ""
+
+    for table in STAGE_TABLES:
+        connection.execute(text(f"DROP {temporary}TABLE IF EXISTS {table.name}"))
+
+
+def merge_term_nt(load: TermLoad, session: SessionObj):
+    """
+    Bulk loads the term into temporary staging tables and merges them into the real ones
+    with a few set based statements, instead of looking at the rows in python
+    """
+    if not load.course_datas:
+        return
+
+    logging.info(f"Merging {load}")
+
+    connection = session.connection()
+
+    # a merge that failed on this connection before could have left them behind
+    drop_stage_tables_nt(session)
+
+    for table in STAGE_TABLES:
+        table.create(connection)
+
+    connection.execute(insert(STAGE_COURSE_DATA), list(load.course_datas.values()))
+
+    if load.course_faculty:
+        connection.execute(
+            insert(STAGE_COURSE_FACULTY),
+            [
+                {"course_id": course_id, "crn": crn, "faculty_id": faculty_id}
+                for course_id, crn, faculty_id in load.course_faculty
+            ],
+        )
+
+    if load.meetings:
+        connection.execute(insert(STAGE_MEETING), list(load.meetings.values()))
+
+    course_data = TBL_Course_Data.__table__
+    stage = STAGE_COURSE_DATA
+
+    same_section = and_(
+        course_data.c.course_id == stage.c.course_id, course_data.c.crn == stage.c.crn
+    )
+
+    # mysql does not promise the order the columns of a multi table update are set in,
+    # so what has to be indexed again is found before anything is overwritten
+    connection.execute(
+        update(course_data)
+        .where(same_section)
+        .where(or_(*(course_data.c[i].is_distinct_from(stage.c[i]) for i in REINDEX_COLUMNS)))
+        .values(should_be_indexed=True)
+    )
+
+    updated = connection.execute(
+        update(course_data)
+        .where(same_section)
+        .values(
+            {
+                course_data.c[i]: stage.c[i]
+                for i in COURSE_DATA_MERGE_COLUMNS
+                if i not in ("course_id", "crn")
+            }
+        )
+    ).rowcount
+
+    inserted = connection.execute(
+        insert(course_data).from_select(
+            COURSE_DATA_MERGE_COLUMNS + ["should_be_indexed"],
+            select(*(stage.c[i] for i in COURSE_DATA_MERGE_COLUMNS), literal(True)).where(
+                ~exists().where(same_section)
+            ),
+        )
+    ).rowcount
+
+    course_faculty = TBL_Course_Faculty.__table__
+    stage = STAGE_COURSE_FACULTY
+
+    connection.execute(
+        insert(course_faculty).from_select(
+            ["course_data_id", "faculty_id"],
+            select(course_data.c.course_data_id, stage.c.faculty_id)
+            .select_from(
+                stage.join(
+                    course_data,
+                    and_(
+                        course_data.c.course_id == stage.c.course_id,
+                        course_data.c.crn == stage.c.crn,
+                    ),
+                )
+            )
+            .where(
+                ~exists().where(
+                    course_faculty.c.course_data_id == course_data.c.course_data_id,
+                    course_faculty.c.faculty_id == stage.c.faculty_id,
+                )
+            ),
+        )
+    )
+
+    meeting = TBL_Meeting.__table__
+    stage = STAGE_MEETING
+
+    meetings_inserted = connection.execute(
+        insert(meeting).from_select(
+            ["course_data_id"] + MEETING_MERGE_COLUMNS,
+            select(course_data.c.course_data_id, *(stage.c[i] for i in MEETING_MERGE_COLUMNS))
+            .select_from(
+                stage.join(
+                    course_data,
+                    and_(
+                        course_data.c.course_id == stage.c.course_id,
+                        course_data.c.crn == stage.c.section_crn,
+                    ),
+                )
+            )
+            .where(
+                ~exists().where(
+                    meeting.c.term_id == stage.c.term_id,
+                    meeting.c.meeting_hash == stage.c.meeting_hash,
+                )
+            ),
+        )
+    ).rowcount
+
+    drop_stage_tables_nt(session)
+
+    metrics.increment("course_data.merged_inserted", inserted)
+    metrics.increment("course_data.merged_updated", updated)
+    metrics.increment("meeting.merged_inserted", meetings_inserted)
+
+    logging.info(
+        f"Merged term: {inserted} new and {updated} existing course datas, {meetings_inserted} new meetings"
+    )
+
+
+# course datas deleted per transaction, keeps the locks short and the memory flat
+DELETE_BATCH_SIZE = 1000
+
+
+def delete_old_data(school_id: int, term_ids: list[int] = None, batch_size: int = DELETE_BATCH_SIZE):
+    """
+    Deletes the course datas of the school that were not seen by its last scrape, along with
+    their meetings, faculty links and restrictions
+
+    Only the given terms are swept if term_ids is given, so a term that was not scraped
+    completely keeps its data
+    """
+    if not school_id or school_id < 1:
+        raise Exception("School value must be non-null and greator than 0")
+
+    if term_ids is not None and not term_ids:
+        return 0
+
+    logging.info(f"Preparing to delete old data for {school_id}")
+
+    session: SessionObj
+    with Session().begin() as session:
+        scrape_id = (
+            session.query(TBL_School.scrape_id_last).filter_by(school_id=school_id).scalar()
+        )
+
+        skipped_term_ids = get_skipped_term_ids_nt(session)
+
+    if skipped_term_ids:
+        logging.warning(f"Sections of terms {sorted(skipped_term_ids)} were skipped, keeping their old data")
+
+    def delete_batch(last_id: int, session: SessionObj):
+        query = (
+            session.query(TBL_Course_Data.course_data_id)
+            .join(TBL_Course, TBL_Course.course_id == TBL_Course_Data.course_id)
+            .join(TBL_Term, TBL_Term.term_id == TBL_Course.term_id)
+            .filter(
+                TBL_Term.school_id == school_id,
+                TBL_Course_Data.scrape_id != scrape_id,
+                TBL_Course_Data.course_data_id > last_id,
+            )
+        )
+
+        if term_ids is not None:
+            query = query.filter(TBL_Term.term_id.in_(term_ids))
+
+        if skipped_term_ids:
+            query = query.filter(TBL_Term.term_id.notin_(skipped_term_ids))
+
+        ids = [
+            row.course_data_id
+            for row in query.order_by(TBL_Course_Data.course_data_id).limit(batch_size)
+        ]
+
+        if not ids:
+            return ids
+
+        for table in (TBL_Meeting, TBL_Course_Faculty, TBL_Course_Restriction):
+            session.execute(Delete(table).where(table.course_data_id.in_(ids)))
+
+        session.execute(Delete(TBL_Course_Data).where(TBL_Course_Data.course_data_id.in_(ids)))
+
+        return ids
+
+    deleted = 0
+    last_id = 0
+
+    while True:
+        ids = run_transaction(delete_batch, last_id)
+
+        if not ids:
+            break
+
+        deleted += len(ids)
+        last_id = ids[-1]
+
+    metrics.increment("course_data.deleted", deleted)
+
+    if deleted:
+        # some of the meetings it knows about are gone now
+        meeting_hash_cache.clear()
+
+    logging.info(f"Deleted {deleted} old course datas for {school_id}")
+
+    return deleted
+
+
+# the asyncio write path, optional since it needs greenlet and an async mysql driver
+# (aiomysql or asyncmy). the writes are the same _nt functions as the sync path,
+# run through AsyncSession.run_sync so their queries do not block the event loop
+
+AsyncSessionMaker = None
+
+
+def init_async_database(driver: str = "aiomysql", size: int = None):
+    """
+    Sets up an asyncio engine for the database init_database set up, with the given async driver
+    """
+    global AsyncSessionMaker
+
+    # only imported here so the sync path does not need greenlet
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    engine = Session.kw.get("bind", None)
+
+    if engine is None:
+        raise Exception("init_database has to be called before init_async_database")
+
+    if dbPool.PoolConfig.size is not None:
+        size = dbPool.PoolConfig.size
+
+    url = engine.url.set(drivername=f"{engine.url.get_backend_name()}+{driver}")
+
+    AsyncSessionMaker = async_sessionmaker(
+        dbPool.create_pooled_async_engine(url, size or engine.pool.size()),
+        expire_on_commit=False,
+    )
+
+    logging.info(f"Async database driver {driver}")
+
+
+def is_async_database():
+    return AsyncSessionMaker is not None
+
+
+async def aclose_async_database():
+    global AsyncSessionMaker
+
+    if AsyncSessionMaker is None:
+        return
+
+    engine = AsyncSessionMaker.kw["bind"]
+    AsyncSessionMaker = None
+
+    dbPool.log_pool(engine.sync_engine)
+
+    await engine.dispose()
+
+
+async def arun_transaction(function, *args):
+    """
+    run_transaction on the asyncio engine
+    """
+    attempt = 0
+
+    while True:
+        try:
+            async with AsyncSessionMaker() as session:
+                async with session.begin():
+                    return await session.run_sync(lambda sync_session: function(*args, sync_session))
+
+        except DBAPIError as e:
+            attempt += 1
+
+            await asyncio.sleep(get_retry_delay(function, e, attempt))
+
+
+async def aadd_terms(school_id: int, term_ids: list[int], term_descriptions: list[str]):
+    if len(term_ids) != len(term_descriptions):
+        raise ValueError("term_ids must be the same length as term_descriptions")
+
+    ids = await arun_transaction(add_terms_nt, school_id, term_ids, term_descriptions)
+
+    term_cache.update({(int(school_id), int(i)): j for i, j in zip(term_ids, ids)})
+
+    return ids
+
+
+async def aadd_courses(term_ids: list[int], course_codes: list[str], course_descriptions: list[str]):
+    return await arun_transaction(add_courses_nt, term_ids, course_codes, course_descriptions)
+
+
+async def aget_section_counts(term_id: int) -> dict[str, int]:
+    return await arun_transaction(get_section_counts_nt, term_id)
+
+
+async def aadd_course_data(
+    school_id: int,
+    course_ids: list[int],
+    datas: list[dict[str]],
+    restrictions: list[dict[str]] = None,
+):
+    """
+    add_course_data on the asyncio engine
+    """
+    restrictions = check_course_data_args(course_ids, datas, restrictions)
+
+    # nothing in run_sync may query the sync engine, it would block the event loop
+    scrape_id = await asyncio.to_thread(get_current_scrape)
+
+    size = WriteConfig.commit_size or len(datas)
+
+    for start in range(0, len(datas), max(1, size)):
+        end = start + size
+
+        # the dimension caches are shared with the sync path and create their misses with it,
+        # after load_dimension_caches those are rare
+        batch = await asyncio.to_thread(
+            prepare_sub_batch,
+            school_id,
+            course_ids[start:end],
+            datas[start:end],
+            restrictions[start:end],
+            scrape_id,
+        )
+
+        # meeting_hash_cache loads a term under a threading lock, which add_meetings_nt would hold
+        # across the awaits of the async session and freeze the loop when two writes need the same
+        # term, so the terms are loaded with the sync engine first
+        await asyncio.to_thread(preload_meeting_hashes, batch[3][3].values())
+
+        waits = await arun_transaction(get_course_data_writer(), *batch, scrape_id)
+
+        await aadd_released_meetings(waits)
+
+        datas[start:end] = [None] * len(datas[start:end])
+        restrictions[start:end] = [None] * len(restrictions[start:end])
+
+
+async def aadd_released_meetings(waits: list[tuple[KeyClaim, dict]]):
+    """
+    add_released_meetings on the asyncio engine
+    """
+    while waits:
+        # the transactions that claimed them can be on this event loop
+        meetings = await asyncio.to_thread(get_released_meetings, waits)
+
+        if not meetings:
+            return
+
+        metrics.increment("meeting.released_inserts", len(meetings))
+
+        await asyncio.to_thread(preload_meeting_hashes, {i["term_id"] for i in meetings})
+
+        waits = await arun_transaction(insert_meetings_nt, meetings)
 
-    with Session().begin() as session:
 
-        last_scrap_id = session.query(TBL_School) \
-                            .filter_by(school_id = school_id) \
-                            .first()
-                            
-
-        datas = (session.query(TBL_Course_Data) 
-                            .join(TBL_Course) 
-                            .join(TBL_Term) 
-                            .join(TBL_School) 
-                            .filter(
-                                TBL_School.school_id == school_id,
-                                TBL_Course_Data.scrape_id != last_scrap_id.scrape_id_last) 
-                            .all())
-                            
-        
-        deleted_query = (Delete(TBL_Course_Data)
-                             .where(
-                                    TBL_Course_Data.course_data_id.in_(
-                                            d.course_data_id for d in datas)
-                                            )
-                                    )
-        
-        session.execute(deleted_query)
-        
\ No newline at end of file
+async def amerge_term(load: TermLoad):
+    await arun_transaction(merge_term_nt, load)
@@ -0,0 +1,284 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from typing import Callable, Hashable, Iterable
+
+from . import metrics
+
+import logging
+
+"""
+Process wide caches for the small lookup tables (class types, subjects, faculty...),
+so writing course data does not have to select them for every section.
+
+A miss is created while holding the cache's create lock, so two threads that miss the same
+value at the same time can not both insert it. The create function is expected to commit
+in its own transaction, otherwise the cache could hand out the id of a row that gets rolled back.
+"""
+
+
+class DimensionCache:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+        self.values: dict[Hashable, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.create_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<DimensionCache {self.name} size={len(self.values)} hit_rate={self.hit_rate():.2%}>"
+
+    def hit_rate(self):
+        with self.lock:
+            total = self.hits + self.misses
+
+            if total == 0:
+                return 0.0
+
+            return self.hits / total
+
+    def _count(self, hits: int, misses: int):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+        metrics.increment(f"cache.{self.name}.hits", hits)
+        metrics.increment(f"cache.{self.name}.misses", misses)
+
+    def update(self, values: dict[Hashable, int]):
+        with self.lock:
+            self.values.update(values)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def get_or_create(self, key: Hashable, create: Callable[[], int]):
+        """
+        Returns the cached id for the key, or creates it with create
+        """
+        with self.lock:
+            value = self.values.get(key, None)
+
+        if value is not None:
+            self._count(1, 0)
+            return value
+
+        self._count(0, 1)
+
+        with self.create_lock:
+            # another thread could have created it while we waited
+            with self.lock:
+                value = self.values.get(key, None)
+
+            if value is None:
+                value = create()
+
+                with self.lock:
+                    self.values[key] = value
+
+        return value
+
+    def get_or_create_many(
+        self, keys: Iterable[Hashable], create: Callable[[list[Hashable]], dict[Hashable, int]]
+    ):
+        """
+        Returns {key: id} for every key, creates all the missing ones with a single call to create
+        """
+        keys = list(dict.fromkeys(keys))
+
+        with self.lock:
+            found = {key: self.values[key] for key in keys if key in self.values}
+
+        self._count(len(found), len(keys) - len(found))
+
+        if len(found) == len(keys):
+            return found
+
+        with self.create_lock:
+            with self.lock:
+                found.update({key: self.values[key] for key in keys if key in self.values})
+
+            missing = [key for key in keys if key not in found]
+
+            if missing:
+                created = create(missing)
+
+                with self.lock:
+                    self.values.update(created)
+
+                found.update(created)
+
+        return found
+
+
+def log_caches(caches: Iterable[DimensionCache]):
+    for cache in caches:
+        logging.info(f"Cache: {cache}")
+
+
+class KeyClaim:
+    """
+    A key claimed by a transaction that did not commit or roll back yet
+    """
+
+    def __init__(self, owner: object) -> None:
+        self.owner = owner
+        self.released = False
+        self.done = threading.Event()
+
+    def __repr__(self) -> str:
+        return f"<KeyClaim done={self.done.is_set()} released={self.released}>"
+
+
+class PartitionedKeyCache:
+    """
+    The keys that exist in a table, loaded a whole partition (like a term) at a time
+
+    Keys are claimed before they are inserted, so two threads can not insert the same key,
+    and released again if the insert is rolled back. A key that is claimed by another owner
+    is handed back with its claim, the other owner can still roll back, see wait
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+        self.partitions: dict[Hashable, set[Hashable]] = {}
+
+        # the claims that were not confirmed or released yet, by partition and key
+        self.claims: dict[Hashable, dict[Hashable, KeyClaim]] = {}
+
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        with self.lock:
+            size = sum(len(i) for i in self.partitions.values())
+
+            return f"<PartitionedKeyCache {self.name} partitions={len(self.partitions)} size={size}>"
+
+    def clear(self):
+        with self.lock:
+            self.partitions.clear()
+
+    def _get_partition(self, partition: Hashable, load: Callable[[Hashable], Iterable[Hashable]]):
+        with self.lock:
+            keys = self.partitions.get(partition, None)
+
+        if keys is not None:
+            return keys
+
+        with self.load_lock:
+            with self.lock:
+                keys = self.partitions.get(partition, None)
+
+            if keys is None:
+                keys = set(load(partition))
+
+                logging.debug(f"Loaded {len(keys)} keys of {self.name} partition {partition}")
+
+                with self.lock:
+                    self.partitions[partition] = keys
+
+        return keys
+
+    def preload(self, partition: Hashable, load: Callable[[Hashable], Iterable[Hashable]]):
+        """
+        Loads the partition if it is not loaded yet
+
+        load runs under a threading lock, so it must not wait on an event loop
+        """
+        self._get_partition(partition, load)
+
+    def claim(
+        self,
+        partition: Hashable,
+        keys: Iterable[Hashable],
+        load: Callable[[Hashable], Iterable[Hashable]],
+        owner: object,
+    ):
+        """
+        Returns the keys that are not in the partition yet, which are now claimed by owner,
+        and the (key, claim) of the keys another owner claimed but did not confirm yet
+
+        A partition that is not loaded yet is loaded with load, see preload
+        """
+        existing = self._get_partition(partition, load)
+
+        new = []
+        waiting = []
+
+        with self.lock:
+            claims = self.claims.setdefault(partition, {})
+
+            for key in keys:
+                if key not in existing:
+                    existing.add(key)
+                    claims[key] = KeyClaim(owner)
+                    new.append(key)
+                    continue
+
+                claim = claims.get(key, None)
+
+                if claim is not None and claim.owner is not owner:
+                    waiting.append((key, claim))
+
+        metrics.increment(f"cache.{self.name}.hits", len(keys) - len(new))
+        metrics.increment(f"cache.{self.name}.misses", len(new))
+
+        return new, waiting
+
+    def confirm(self, partition: Hashable, keys: Iterable[Hashable]):
+        """
+        The claimed keys were written
+        """
+        self._finish(partition, keys, False)
+
+    def release(self, partition: Hashable, keys: Iterable[Hashable]):
+        """
+        The claimed keys were not written after all
+        """
+        with self.lock:
+            existing = self.partitions.get(partition, None)
+
+            if existing is not None:
+                existing.difference_update(keys)
+
+        self._finish(partition, keys, True)
+
+    def _finish(self, partition: Hashable, keys: Iterable[Hashable], released: bool):
+        with self.lock:
+            claims = self.claims.get(partition, {})
+
+            finished = [claims.pop(key) for key in keys if key in claims]
+
+        for claim in finished:
+            claim.released = released
+            claim.done.set()
+
+    def wait(self, claim: KeyClaim):
+        """
+        Waits for the owner of the claim to confirm or release it, returns True if it was released
+
+        The owner can be waiting on locks the caller holds, so never wait inside a transaction
+        """
+        claim.done.wait()
+
+        return claim.released
@@ -0,0 +1,150 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from sqlalchemy import event
+from sqlalchemy.engine import URL, Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from . import dataUtil
+from . import metrics
+
+import logging
+
+"""
+The database connection pool, sized for everything in the process that can hold a connection
+at the same time (the extractors' terms, the database writers and the main thread).
+
+How long threads wait for a connection and how often connections are opened and closed
+is kept in the metrics, so a pool that is too small or keeps reconnecting shows up at the end of a run.
+"""
+
+
+class PoolConfig:
+    # connections kept open, None sizes it from the threads that use the database
+    size = None
+
+    # connections that can be opened on top of size when every one is in use
+    max_overflow = 4
+
+    # seconds to wait for a connection before giving up
+    timeout = 30
+
+    # seconds before a connection is replaced, under mysql's wait_timeout
+    # so the server never closes it first
+    recycle = 1800
+
+    # test a connection before handing it out, it could have been closed by the server or a failover
+    pre_ping = True
+
+
+class _MeteredPool:
+    """
+    Records how long every checkout waited for a connection
+    """
+
+    def _do_get(self):
+        started_at = dataUtil.time_now_precise()
+
+        try:
+            return super()._do_get()
+
+        finally:
+            waited = dataUtil.time_now_precise() - started_at
+
+            metrics.increment("db_pool.checkouts")
+            metrics.increment("db_pool.checkout_wait_seconds", waited)
+
+
+class MeteredQueuePool(_MeteredPool, QueuePool):
+    pass
+
+
+class MeteredAsyncQueuePool(_MeteredPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def _count(name: str):
+    def listener(*_):
+        metrics.increment(name)
+
+    return listener
+
+
+def _pool_args(size: int):
+    return {
+        "pool_size": size,
+        "max_overflow": PoolConfig.max_overflow,
+        "pool_timeout": PoolConfig.timeout,
+        "pool_recycle": PoolConfig.recycle,
+        "pool_pre_ping": PoolConfig.pre_ping,
+    }
+
+
+def _listen(engine: Engine):
+    # the churn, every one of these is a new connection to the server
+    event.listen(engine, "connect", _count("db_pool.connections_opened"))
+    event.listen(engine, "close", _count("db_pool.connections_closed"))
+    event.listen(engine, "invalidate", _count("db_pool.connections_invalidated"))
+
+
+def pool_engine(engine: Engine, size: int):
+    """
+    Replaces the pool of engine with a metered one of size connections
+
+    The engine is kept, with the options and connect_args it was created with, the same way
+    Engine.dispose recreates its pool. The old pool is disposed
+    """
+    old = engine.pool
+
+    engine.pool = MeteredQueuePool(
+        # connects with the engine's connect_args
+        old._creator,
+        pool_size=size,
+        max_overflow=PoolConfig.max_overflow,
+        timeout=PoolConfig.timeout,
+        recycle=PoolConfig.recycle,
+        pre_ping=PoolConfig.pre_ping,
+        echo=old.echo,
+        logging_name=old._orig_logging_name,
+        reset_on_return=old._reset_on_return,
+        # the listeners the dialect and whoever created the engine added, e.g. for isolation_level
+        _dispatch=old.dispatch,
+        dialect=old._dialect,
+    )
+
+    old.dispose()
+
+    _listen(engine)
+
+
+def create_pooled_async_engine(url: URL, size: int):
+    """
+    A metered asyncio engine of size connections, url has to name an async driver
+    """
+    # only imported here, it needs greenlet which is optional
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    engine = create_async_engine(url, poolclass=MeteredAsyncQueuePool, **_pool_args(size))
+
+    _listen(engine.sync_engine)
+
+    return engine
+
+
+def log_pool(engine: Engine):
+    if engine is None:
+        return
+
+    logging.info(f"Database pool: {engine.pool.status()}")
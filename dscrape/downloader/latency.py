@@ -0,0 +1,118 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from collections import deque
+
+import logging
+
+"""
+Latency tracking per host and endpoint, used to pick timeouts from what the host actually does
+instead of a fixed worst case.
+"""
+
+
+class LatencyConfig:
+    # how many of the latest samples are kept per host and endpoint
+    window = 256
+
+    # fixed timeouts are used until this many samples were seen
+    min_samples = 10
+
+    timeout_percentile = 99
+    timeout_multiplier = 3.0
+
+    # never time out faster than this, even if the host is always quick
+    timeout_floor = 10.0
+
+    # a hedged request sends its duplicate once it is slower than this percentile
+    hedge_percentile = 95
+
+
+class LatencyTracker:
+    def __init__(self, hostname: str, endpoint: str) -> None:
+        self.hostname = hostname
+        self.endpoint = endpoint
+
+        self.samples : deque[float] = deque(maxlen=LatencyConfig.window)
+        self.count : int = 0
+
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        p50, p95, p99 = (self.percentile(i) for i in (50, 95, 99))
+
+        if p50 is None:
+            return f"<LatencyTracker {self.hostname} {self.endpoint} samples={self.count}>"
+
+        return (
+            f"<LatencyTracker {self.hostname} {self.endpoint} samples={self.count} "
+            f"p50={p50:.2f}s p95={p95:.2f}s p99={p99:.2f}s>"
+        )
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, p: float):
+        """
+        Returns the p-th percentile of the recent samples, or None if there are not enough samples
+        """
+        with self.lock:
+            if len(self.samples) < LatencyConfig.min_samples:
+                return None
+
+            ordered = sorted(self.samples)
+
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+
+        return ordered[index]
+
+    def timeout(self, cap: float):
+        """
+        A multiple of the observed tail latency, kept between the floor and the given cap
+        """
+        p = self.percentile(LatencyConfig.timeout_percentile)
+
+        if p is None:
+            return cap
+
+        return min(cap, max(LatencyConfig.timeout_floor, p * LatencyConfig.timeout_multiplier))
+
+
+_lock = threading.Lock()
+_trackers: dict[tuple[str, str], LatencyTracker] = {}
+
+
+def get_tracker(hostname: str, endpoint: str) -> LatencyTracker:
+    key = (hostname, endpoint)
+
+    with _lock:
+        tracker = _trackers.get(key, None)
+
+        if tracker is None:
+            tracker = LatencyTracker(hostname, endpoint)
+            _trackers[key] = tracker
+
+        return tracker
+
+
+def log_latencies():
+    with _lock:
+        trackers = list(_trackers.values())
+
+    for tracker in trackers:
+        logging.info(f"Latency: {tracker}")
@@ -0,0 +1,254 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import httpx
+
+import time
+import asyncio
+import threading
+import email.utils
+
+import logging
+
+"""
+Per host concurrency and request rate limiting.
+
+Both limits follow AIMD (additive increase, multiplicative decrease), the same idea as TCP
+congestion control: every request that comes back without latency spiking raises the limits a
+little, and every sign of overload (5xx, 429, Retry-After or a timeout) cuts them in half.
+Fast hosts end up with high limits while fragile ones settle at whatever they can handle.
+"""
+
+
+class LimiterConfig:
+    initial_concurrency = 4.0
+    min_concurrency = 1.0
+    max_concurrency = 10.0
+
+    # requests per second
+    initial_rate = 5.0
+    min_rate = 0.25
+    max_rate = 50.0
+
+    decrease_factor = 0.5
+
+    # a response slower than this many times the average latency counts as unstable
+    latency_tolerance = 2.0
+    latency_smoothing = 0.1
+
+    # only cut the limits once per this many seconds, a burst of failures from
+    # requests that were all sent at the same time is a single congestion event
+    decrease_cooldown = 2.0
+
+    # how long to wait when a host sent a Retry-After that we could not parse
+    default_retry_after = 5.0
+
+
+def configure(max_concurrency: float = None, initial_concurrency: float = None, max_rate: float = None):
+    if max_concurrency is not None:
+        LimiterConfig.max_concurrency = max_concurrency
+
+    if initial_concurrency is not None:
+        LimiterConfig.initial_concurrency = initial_concurrency
+
+    if max_rate is not None:
+        LimiterConfig.max_rate = max_rate
+
+    LimiterConfig.initial_concurrency = min(
+        LimiterConfig.initial_concurrency, LimiterConfig.max_concurrency
+    )
+
+
+def parse_retry_after(response: httpx.Response):
+    """
+    Returns the Retry-After header of the response in seconds, or None if it has none
+    """
+    if response is None:
+        return None
+
+    value = response.headers.get("Retry-After", None)
+
+    if value is None:
+        return None
+
+    value = value.strip()
+
+    if value.isdigit():
+        return float(value)
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return LimiterConfig.default_retry_after
+
+    return max(0.0, date.timestamp() - time.time())
+
+
+def is_congestion_status(status_code: int):
+    return status_code == 429 or status_code >= 500
+
+
+class HostLimiter:
+    def __init__(self, hostname: str) -> None:
+        self.hostname = hostname
+
+        self.concurrency_limit : float = LimiterConfig.initial_concurrency
+        self.rate : float = LimiterConfig.initial_rate
+
+        self.in_flight : int = 0
+        self.tokens : float = 1.0
+        self.last_refill : float = time.monotonic()
+
+        self.latency_avg : float = None
+        self.last_decrease : float = 0.0
+        self.paused_until : float = 0.0
+
+        self.condition = threading.Condition()
+
+    def __repr__(self) -> str:
+        return (
+            f"<HostLimiter {self.hostname} concurrency={self.concurrency_limit:.2f} "
+            f"rate={self.rate:.2f}/s in_flight={self.in_flight}>"
+        )
+
+    def _refill(self, now: float):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_acquire(self):
+        """
+        Takes a slot if one is free, returns 0 on success or how long to wait before trying again
+        """
+        with self.condition:
+            now = time.monotonic()
+
+            if now < self.paused_until:
+                return self.paused_until - now
+
+            self._refill(now)
+
+            if self.in_flight >= int(self.concurrency_limit):
+                # woken up by release, the timeout is only a fallback
+                return 1.0
+
+            if self.tokens < 1.0:
+                return (1.0 - self.tokens) / self.rate
+
+            self.tokens -= 1.0
+            self.in_flight += 1
+
+            return 0
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+
+            if wait == 0:
+                return
+
+            with self.condition:
+                self.condition.wait(timeout=wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.try_acquire()
+
+            if wait == 0:
+                return
+
+            # the condition cannot be awaited, so poll a little faster than we would block
+            await asyncio.sleep(min(wait, 0.05))
+
+    def release(self, latency: float = None, congested: bool = False, retry_after: float = None):
+        with self.condition:
+            self.in_flight -= 1
+
+            if congested or retry_after is not None:
+                self._on_congestion(retry_after)
+
+            elif latency is not None:
+                self._on_success(latency)
+
+            self.condition.notify_all()
+
+    def release_response(self, response: httpx.Response, latency: float):
+        retry_after = None
+        congested = is_congestion_status(response.status_code)
+
+        if congested:
+            retry_after = parse_retry_after(response)
+
+        self.release(latency, congested, retry_after)
+
+    def _on_success(self, latency: float):
+        stable = (
+            self.latency_avg is None
+            or latency <= self.latency_avg * LimiterConfig.latency_tolerance
+        )
+
+        if self.latency_avg is None:
+            self.latency_avg = latency
+        else:
+            self.latency_avg += (latency - self.latency_avg) * LimiterConfig.latency_smoothing
+
+        if not stable:
+            return
+
+        # roughly +1 per full window of successful requests
+        self.concurrency_limit = min(
+            LimiterConfig.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit
+        )
+        self.rate = min(LimiterConfig.max_rate, self.rate + 1.0 / self.rate)
+
+    def _on_congestion(self, retry_after: float = None):
+        now = time.monotonic()
+
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+        if now - self.last_decrease < LimiterConfig.decrease_cooldown:
+            return
+
+        self.last_decrease = now
+
+        self.concurrency_limit = max(
+            LimiterConfig.min_concurrency, self.concurrency_limit * LimiterConfig.decrease_factor
+        )
+        self.rate = max(LimiterConfig.min_rate, self.rate * LimiterConfig.decrease_factor)
+
+        logging.info(f"Backing off {self.hostname}: {self}")
+
+
+_lock = threading.Lock()
+_limiters: dict[str, HostLimiter] = {}
+
+
+def get_limiter(hostname: str) -> HostLimiter:
+    with _lock:
+        limiter = _limiters.get(hostname, None)
+
+        if limiter is None:
+            limiter = HostLimiter(hostname)
+            _limiters[hostname] = limiter
+
+        return limiter
+
+
+def log_limits():
+    with _lock:
+        limiters = list(_limiters.values())
+
+    for limiter in limiters:
+        logging.info(f"Final limits: {limiter}")
@@ -0,0 +1,175 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import httpx
+
+import threading
+import importlib.util
+
+import logging
+
+"""
+Process wide connection pools, one per hostname.
+
+Every requester gets its own httpx client (and so its own cookie jar), but the client's
+transport hands the request to the pool for the request's host. Dumpers that share a host
+(UOIT and DC are both on ssp.mycampus.ca) then reuse the same keep-alive / HTTP/2 connections
+instead of each paying for their own TCP and TLS handshakes.
+"""
+
+
+class PoolConfig:
+    max_connections = 10
+    max_keepalive_connections = 10
+    keepalive_expiry = 30.0
+    http2 = True
+
+    # hostname -> max connections, overrides max_connections for that host
+    host_max_connections: dict[str, int] = {}
+
+
+# the request extension that sends a request on the host's hedge pool
+HEDGE_EXTENSION = "dscrape_hedge"
+
+_lock = threading.Lock()
+_transports: dict[str, httpx.HTTPTransport] = {}
+_async_transports: dict[str, httpx.AsyncHTTPTransport] = {}
+
+# hedged duplicates get their own connections, so they are not stuck behind the slow one
+_hedge_transports: dict[str, httpx.HTTPTransport] = {}
+_async_hedge_transports: dict[str, httpx.AsyncHTTPTransport] = {}
+
+
+def http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+
+def configure(max_connections: int = None, keepalive_expiry: float = None, http2: bool = None):
+    """
+    Sets the pool settings, only applies to pools created after this is called
+    """
+    if max_connections is not None:
+        PoolConfig.max_connections = max_connections
+        PoolConfig.max_keepalive_connections = max_connections
+
+    if keepalive_expiry is not None:
+        PoolConfig.keepalive_expiry = keepalive_expiry
+
+    if http2 is not None:
+        PoolConfig.http2 = http2
+
+    if PoolConfig.http2 and not http2_available():
+        logging.warning("HTTP/2 was requested but the h2 package is not installed, using HTTP/1.1")
+        PoolConfig.http2 = False
+
+
+def set_host_max_connections(hostname: str, max_connections: int):
+    PoolConfig.host_max_connections[hostname] = max_connections
+
+
+def get_limits(hostname: str):
+    max_connections = PoolConfig.host_max_connections.get(hostname, PoolConfig.max_connections)
+
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=min(max_connections, PoolConfig.max_keepalive_connections),
+        keepalive_expiry=PoolConfig.keepalive_expiry,
+    )
+
+
+def use_http2():
+    return PoolConfig.http2 and http2_available()
+
+
+def get_transport(hostname: str, hedge: bool = False) -> httpx.HTTPTransport:
+    transports = _hedge_transports if hedge else _transports
+
+    with _lock:
+        transport = transports.get(hostname, None)
+
+        if transport is None:
+            logging.debug(f"Creating {'hedge ' if hedge else ''}connection pool for {hostname}")
+
+            transport = httpx.HTTPTransport(http2=use_http2(), limits=get_limits(hostname))
+            transports[hostname] = transport
+
+        return transport
+
+
+def get_async_transport(hostname: str, hedge: bool = False) -> httpx.AsyncHTTPTransport:
+    transports = _async_hedge_transports if hedge else _async_transports
+
+    with _lock:
+        transport = transports.get(hostname, None)
+
+        if transport is None:
+            logging.debug(
+                f"Creating async {'hedge ' if hedge else ''}connection pool for {hostname}"
+            )
+
+            transport = httpx.AsyncHTTPTransport(http2=use_http2(), limits=get_limits(hostname))
+            transports[hostname] = transport
+
+        return transport
+
+
+def close_all():
+    with _lock:
+        transports = list(_transports.values()) + list(_hedge_transports.values())
+        _transports.clear()
+        _hedge_transports.clear()
+
+    for transport in transports:
+        transport.close()
+
+
+async def aclose_all():
+    with _lock:
+        transports = list(_async_transports.values()) + list(_async_hedge_transports.values())
+        _async_transports.clear()
+        _async_hedge_transports.clear()
+
+    for transport in transports:
+        await transport.aclose()
+
+
+class SharedTransport(httpx.BaseTransport):
+    """
+    Routes every request to the process wide pool for its host
+    """
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        hedge = request.extensions.get(HEDGE_EXTENSION, False)
+
+        return get_transport(request.url.host, hedge).handle_request(request)
+
+    def close(self) -> None:
+        # the pools outlive any single client, they are closed with close_all
+        pass
+
+
+class AsyncSharedTransport(httpx.AsyncBaseTransport):
+    """
+    Routes every request to the process wide async pool for its host
+    """
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        hedge = request.extensions.get(HEDGE_EXTENSION, False)
+
+        return await get_async_transport(request.url.host, hedge).handle_async_request(request)
+
+    async def aclose(self) -> None:
+        # the pools outlive any single client, they are closed with aclose_all
+        pass
@@ -16,24 +16,211 @@
 import httpx
 
 import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import logging
 
+from . import pool
+from . import limiter
+from . import resilience
+from . import latency
 
-class Requester:
-    def __init__(self, retries=float("inf"), timeout=32) -> None:
-        self.session : httpx.Client = httpx.Client()
+
+DEFAULT_RETRIES = 8
+
+# timeouts grow by the base timeout on every timed out attempt, up to this many times the base
+MAX_TIMEOUT_SCALE = 3
+
+# threads a Requester runs hedged requests on, every hedged request in flight needs two
+HEDGE_THREADS = 8
+
+
+def close_losing_response(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    response = future.result()
+
+    if response is not None:
+        response.close()
+
+
+class RequestState:
+    """
+    The retry, breaker, limiter and latency bookkeeping of a single request,
+    the requesters only do the sleeping and the sending
+    """
+
+    def __init__(self, requester: "BaseRequester", method: str, url: str, kwargs: dict) -> None:
+        self.requester = requester
+        self.method = method
+        self.url = url
+
+        self.endpoint = kwargs.pop("endpoint", None)
+        self.client = kwargs.pop("client", None) or requester.session
+
+        # set when the other request of a hedge won, the attempts stop as soon as they see it
+        self.cancel: threading.Event = kwargs.pop("cancel", None)
+
+        # hedged duplicates go out on their own connections, see pool.HEDGE_EXTENSION
+        self.hedge: bool = kwargs.pop("hedge", False)
+        self.headers, self.timeout = requester.prepare_request(kwargs)
+
+        # the last response, returned as is when we give up so the caller can see the bad status
+        self.response: httpx.Response = None
+        self.tries: int = 0
+        self.timeout_scale = 1
+        self.retry_after = None
+
+        self.attempt_timeout = None
+        self.started_at = None
+
+        hostname = httpx.URL(url).host
+        self.host_limiter = limiter.get_limiter(hostname)
+        self.breaker = resilience.get_breaker(hostname)
+        self.budget = resilience.get_retry_budget(hostname)
+        self.hedge_budget = resilience.get_hedge_budget(hostname)
+        self.tracker = latency.get_tracker(hostname, self.endpoint) if self.endpoint else None
+
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def can_retry(self):
+        return self.requester.can_retry(self.tries, self.budget, self.method, self.url)
+
+    def pop_response(self):
+        """
+        The response of the failed attempt, which has to be closed before retrying
+        """
+        response = self.response
+        self.response = None
+
+        return response
+
+    def retry_delay(self):
+        delay = resilience.backoff_delay(self.tries, self.retry_after)
+        self.retry_after = None
+
+        logging.debug(f"Retrying {self.method} to {self.url} after {delay:.2f} seconds")
+
+        return delay
+
+    def start_attempt(self):
+        """
+        Called before waiting on the host limiter, raises CircuitOpenError if the host is down
+        """
+        self.breaker.check()
+        self.budget.record_request()
+        self.hedge_budget.record_request()
+
+    def send_kwargs(self):
+        """
+        Called once the host limiter let the attempt through, the arguments for client.request
+        """
+        self.attempt_timeout = self.requester.get_timeout(
+            self.timeout, self.tracker, self.timeout_scale
+        )
+        self.started_at = time.perf_counter()
+
+        if self.hedge:
+            return {
+                "headers": self.headers,
+                "timeout": self.attempt_timeout,
+                "extensions": {pool.HEDGE_EXTENSION: True},
+            }
+
+        return {"headers": self.headers, "timeout": self.attempt_timeout}
+
+    def record_error(self, exc: Exception):
+        """
+        The attempt raised, returns True if it should be retried
+        """
+        if isinstance(exc, httpx.TimeoutException):
+            if self.tracker:
+                # we only know it took at least this long, but that is enough to push the
+                # percentiles up for a host that is slowing down
+                self.tracker.record(self.attempt_timeout)
+
+            self.timeout_scale = min(MAX_TIMEOUT_SCALE, self.timeout_scale + 1)
+
+        if isinstance(exc, (httpx.TimeoutException, httpx.ConnectError, httpx.RemoteProtocolError)):
+            self.host_limiter.release(congested=True)
+            self.breaker.record_failure()
+            self.tries += 1
+            logging.warning(exc)
+            return True
+
+        self.host_limiter.release()
+        self.breaker.record_abort()
+        logging.error(exc)
+        return False
+
+    def record_abort(self):
+        """
+        Cancelled or interrupted, gives the slot back so the caller can let it propagate
+        """
+        self.host_limiter.release()
+        self.breaker.record_abort()
+
+    def record_response(self, response: httpx.Response):
+        """
+        Got a response, returns True if it is the one to return
+        """
+        elapsed = time.perf_counter() - self.started_at
+        self.host_limiter.release_response(response, elapsed)
+
+        if self.tracker:
+            self.tracker.record(elapsed)
+
+        self.response = response
+
+        if response.status_code in resilience.RETRY_STATUS_CODES:
+            if response.status_code == 429:
+                # rate limited, but the host is clearly up
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+            self.retry_after = limiter.parse_retry_after(response)
+            self.tries += 1
+
+            logging.warning(
+                f"{self.method} to {self.url} got status code {response.status_code} with reason: {response.reason_phrase}"
+            )
+            return False
+
+        if response.status_code >= 500:
+            # not worth retrying, but the host is not healthy either
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        return True
+
+
+class BaseRequester:
+    """
+    Holds the request settings shared by the sync and async requesters
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, timeout=32) -> None:
+        self.session = self.create_session()
         self.chunk_size : int = 16384
 
         self.headers : dict[str, str] = {}
         self.retries : int = retries
         self.timeout : int = timeout
 
-    def request(self, method, url, **kwargs):
-        response: httpx.Response = None
-        tries   : int = 0
+    def create_session(self):
+        raise RuntimeError("BaseRequester.create_session is abstract and cannot be called")
+
+    def prepare_request(self, kwargs: dict):
+        """
+        Pops the headers and timeout out of kwargs and merges them with the defaults
+        """
         headers : dict[str, str] = {"Accept": "*/*"}
-        timeout_scale = 1
         timeout = self.timeout
 
         if self.headers:
@@ -43,41 +230,275 @@ class Requester:
             headers.update(kwargs["headers"])
             del kwargs["headers"]
 
-        if "timeout" in kwargs: 
+        if "timeout" in kwargs:
             timeout = kwargs["timeout"]
             del kwargs["timeout"]
 
+        return headers, timeout
+
+    def get_timeout(self, timeout: float, tracker: latency.LatencyTracker, timeout_scale: int):
+        """
+        The timeout for one attempt, the given timeout is used as the upper limit
+        when the endpoint's latency is being tracked
+        """
+        if tracker is None:
+            return timeout * timeout_scale
+
+        return min(timeout, tracker.timeout(timeout) * timeout_scale)
+
+    def get_hedge_delay(self, url: str, endpoint: str):
+        """
+        How long to wait before sending a hedged duplicate, None if the request should not be hedged
+        """
+        if endpoint is None:
+            return None
+
+        return latency.get_tracker(httpx.URL(url).host, endpoint).percentile(
+            latency.LatencyConfig.hedge_percentile
+        )
+
+    def can_retry(self, tries: int, budget: resilience.RetryBudget, method: str, url: str):
+        if tries > self.retries:
+            logging.warning(f"Giving up on {method} to {url} after {tries} tries")
+            return False
+
+        if not budget.try_withdraw():
+            logging.warning(f"Retry budget for {budget.hostname} is empty, giving up on {method} to {url}")
+            return False
+
+        return True
+
+
+class Requester(BaseRequester):
+    def __init__(self, retries=DEFAULT_RETRIES, timeout=32) -> None:
+        super().__init__(retries, timeout)
+
+        # runs both requests of a hedge, created by the first one
+        self.hedge_executor: ThreadPoolExecutor = None
+        self.hedge_lock = threading.Lock()
+
+    def create_session(self) -> httpx.Client:
+        # cookies stay on the client, connections come from the shared per host pool
+        return httpx.Client(transport=pool.SharedTransport())
+
+    def close(self):
+        self.session.close()
+        self.close_hedge_executor()
+
+    def get_hedge_executor(self):
+        with self.hedge_lock:
+            if self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(
+                    max_workers=HEDGE_THREADS, thread_name_prefix="hedge"
+                )
+
+            return self.hedge_executor
+
+    def close_hedge_executor(self):
+        with self.hedge_lock:
+            executor = self.hedge_executor
+            self.hedge_executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def request(self, method, url, **kwargs):
+        state = RequestState(self, method, url, kwargs)
+
         while True:
-            if tries > 0:
+            if state.cancelled():
+                # the other request of the hedge won, do not spend any more budget on this one
+                response = state.pop_response()
+
+                if response:
+                    response.close()
+
+                return None
+
+            if state.tries > 0:
+                if not state.can_retry():
+                    # the caller decides what to do with the last bad status, if there was one
+                    return state.response
+
+                response = state.pop_response()
+
                 if response:
                     response.close()
-                    response = None
 
-                if tries > self.retries:
-                    return None
+                if state.cancel is None:
+                    time.sleep(state.retry_delay())
+
+                elif state.cancel.wait(state.retry_delay()):
+                    continue
 
-                logging.debug(f"Retrying {method} to {url} after {tries} seconds")
+            state.start_attempt()
+            state.host_limiter.acquire()
 
-                time.sleep(tries)
+            if state.cancelled():
+                state.record_abort()
+                return None
 
             try:
-                response = self.session.request(
-                    method,
-                    url,
-                    headers=headers,
-                    timeout=(timeout * timeout_scale),
-                    **kwargs,
-                )
-            except httpx.TimeoutException as exc:
-                timeout_scale += 1
-                logging.warning(exc)
-                continue
-            except (httpx.ConnectError, httpx.RemoteProtocolError) as exc:
-                logging.warning(exc)
-                continue
+                response = state.client.request(method, url, **state.send_kwargs(), **kwargs)
 
             except Exception as exc:
-                logging.error(exc)
+                if state.record_error(exc):
+                    continue
+
                 return None
 
-            return response
+            except BaseException:
+                state.record_abort()
+                raise
+
+            if state.record_response(response):
+                return response
+
+    def hedged_request(self, method, url, **kwargs):
+        """
+        Same as request, but if there is no response by the host's p95 latency for the endpoint
+        a duplicate request is sent on another connection and whichever answers first is used
+
+        The duplicate shares the client's cookies, banner only searches the term bound to them.
+        The losing request stops retrying once the winner is in, and its response is closed
+        """
+        delay = self.get_hedge_delay(url, kwargs.get("endpoint", None))
+
+        if delay is None:
+            return self.request(method, url, **kwargs)
+
+        executor = self.get_hedge_executor()
+        cancel = threading.Event()
+
+        # request pops from kwargs, so every call needs its own copy
+        futures = [executor.submit(self.request, method, url, **dict(kwargs, cancel=cancel))]
+        winner = futures[0]
+
+        try:
+            done, pending = wait(futures, timeout=delay)
+
+            if done or not resilience.get_hedge_budget(httpx.URL(url).host).try_withdraw():
+                return winner.result()
+
+            logging.debug(f"Hedging {method} to {url} after {delay:.2f} seconds")
+
+            futures.append(
+                executor.submit(self.request, method, url, **dict(kwargs, cancel=cancel, hedge=True))
+            )
+            winner = None
+            pending = set(futures)
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future.result() is not None:
+                        winner = future
+
+                        return future.result()
+
+            return None
+
+        finally:
+            cancel.set()
+
+            for future in futures:
+                if future is not winner and not future.cancel():
+                    future.add_done_callback(close_losing_response)
+
+
+class AsyncRequester(BaseRequester):
+    """
+    Same as Requester but built on httpx.AsyncClient, so many requests can be in flight
+    on a single event loop instead of needing a thread each
+    """
+
+    def create_session(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=pool.AsyncSharedTransport())
+
+    async def aclose(self):
+        await self.session.aclose()
+
+    async def request(self, method, url, **kwargs):
+        state = RequestState(self, method, url, kwargs)
+
+        while True:
+            if state.tries > 0:
+                if not state.can_retry():
+                    # the caller decides what to do with the last bad status, if there was one
+                    return state.response
+
+                response = state.pop_response()
+
+                if response:
+                    await response.aclose()
+
+                await asyncio.sleep(state.retry_delay())
+
+            state.start_attempt()
+            await state.host_limiter.acquire_async()
+
+            try:
+                response = await state.client.request(method, url, **state.send_kwargs(), **kwargs)
+
+            except Exception as exc:
+                if state.record_error(exc):
+                    continue
+
+                return None
+
+            except BaseException:
+                state.record_abort()
+                raise
+
+            if state.record_response(response):
+                return response
+
+    async def hedged_request(self, method, url, **kwargs):
+        """
+        Same as request, but if there is no response by the host's p95 latency for the endpoint
+        a duplicate request is sent on another connection, whichever answers first is used
+        and the other is cancelled
+        """
+        delay = self.get_hedge_delay(url, kwargs.get("endpoint", None))
+
+        if delay is None:
+            return await self.request(method, url, **kwargs)
+
+        # request pops from kwargs, so every call needs its own copy
+        tasks = [asyncio.create_task(self.request(method, url, **dict(kwargs)))]
+        winner = tasks[0]
+
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+
+            if done or not resilience.get_hedge_budget(httpx.URL(url).host).try_withdraw():
+                return await winner
+
+            logging.debug(f"Hedging {method} to {url} after {delay:.2f} seconds")
+
+            tasks.append(asyncio.create_task(self.request(method, url, **dict(kwargs, hedge=True))))
+            winner = None
+            pending = set(tasks)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.result() is not None:
+                        winner = task
+
+                        return task.result()
+
+            return None
+
+        finally:
+            losers = [task for task in tasks if task is not winner]
+
+            for task in losers:
+                task.cancel()
+
+            # both can finish in the same wakeup, the loser's response still holds a connection
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                if isinstance(result, httpx.Response):
+                    await result.aclose()
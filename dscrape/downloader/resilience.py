@@ -0,0 +1,239 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import random
+import threading
+from collections import deque
+
+import logging
+
+"""
+Retry backoff, per host retry budgets and per host circuit breakers.
+
+The budget stops retries from multiplying the load on a host that is already struggling,
+and the breaker stops us from waiting on a host that is clearly down at all.
+"""
+
+
+class RetryConfig:
+    backoff_base = 0.5
+    backoff_cap = 60.0
+
+    # every request earns this many retries for its host, on top of budget_min
+    budget_ratio = 0.2
+    budget_min = 20.0
+    budget_max = 200.0
+
+    # hedged requests get their own, much smaller budget so they can never double the load
+    hedge_ratio = 0.1
+    hedge_min = 2.0
+    hedge_max = 10.0
+
+    # failures in a row within breaker_window seconds before the breaker opens, well above
+    # the attempts a single request makes so one bad request can not take the whole host down
+    breaker_threshold = 24
+    breaker_window = 60.0
+    breaker_cooldown = 30.0
+    breaker_max_cooldown = 10 * 60.0
+
+
+# statuses that are worth sending the exact same request again for
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request is made to a host whose circuit breaker is open
+    """
+
+    def __init__(self, hostname: str, retry_in: float) -> None:
+        super().__init__(f"Circuit breaker for {hostname} is open, retry in {retry_in:.0f} seconds")
+
+        self.hostname = hostname
+        self.retry_in = retry_in
+
+
+def backoff_delay(attempt: int, retry_after: float = None):
+    """
+    Exponential backoff with jitter, attempt starts at 1
+
+    Half of the delay is fixed and half is random so workers that failed together
+    do not all come back at the same moment
+    """
+    delay = min(RetryConfig.backoff_cap, RetryConfig.backoff_base * (2 ** (attempt - 1)))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RetryConfig.backoff_cap))
+
+    return delay
+
+
+class RetryBudget:
+    """
+    Token bucket of retries that is shared by every requester talking to the same host
+    """
+
+    def __init__(
+        self, hostname: str, ratio: float = None, minimum: float = None, maximum: float = None
+    ) -> None:
+        self.hostname = hostname
+
+        self.ratio = RetryConfig.budget_ratio if ratio is None else ratio
+        self.balance = RetryConfig.budget_min if minimum is None else minimum
+        self.maximum = RetryConfig.budget_max if maximum is None else maximum
+
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.balance = min(self.maximum, self.balance + self.ratio)
+
+    def try_withdraw(self):
+        with self.lock:
+            if self.balance < 1.0:
+                return False
+
+            self.balance -= 1.0
+
+            return True
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, hostname: str) -> None:
+        self.hostname = hostname
+
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.failure_times: deque[float] = deque()
+        self.cooldown = RetryConfig.breaker_cooldown
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+        self.lock = threading.Lock()
+
+    def check(self):
+        """
+        Raises CircuitOpenError if a request to this host should not be sent right now
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+
+            retry_in = self.opened_at + self.cooldown - time.monotonic()
+
+            if self.state == CircuitBreaker.OPEN and retry_in <= 0:
+                logging.info(f"Circuit breaker for {self.hostname} is half-open, sending a probe")
+                self.state = CircuitBreaker.HALF_OPEN
+
+            if self.state == CircuitBreaker.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+
+            raise CircuitOpenError(self.hostname, max(0.0, retry_in))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.failure_times.clear()
+            self.probe_in_flight = False
+
+            if self.state != CircuitBreaker.CLOSED:
+                logging.info(f"Circuit breaker for {self.hostname} closed")
+
+                self.state = CircuitBreaker.CLOSED
+                self.cooldown = RetryConfig.breaker_cooldown
+
+    def record_failure(self):
+        with self.lock:
+            now = time.monotonic()
+
+            self.failure_times.append(now)
+
+            # failures that are too old to say anything about the host now
+            while self.failure_times[0] < now - RetryConfig.breaker_window:
+                self.failure_times.popleft()
+
+            self.failures = len(self.failure_times)
+
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.probe_in_flight = False
+                self.cooldown = min(RetryConfig.breaker_max_cooldown, self.cooldown * 2)
+                self._open()
+
+            elif self.state == CircuitBreaker.CLOSED and self.failures >= RetryConfig.breaker_threshold:
+                self._open()
+
+    def record_abort(self):
+        """
+        The request was cancelled before we learned anything about the host
+        """
+        with self.lock:
+            self.probe_in_flight = False
+
+    def _open(self):
+        self.state = CircuitBreaker.OPEN
+        self.opened_at = time.monotonic()
+
+        logging.error(
+            f"Circuit breaker for {self.hostname} opened after {self.failures} failures, "
+            f"cooling down for {self.cooldown:.0f} seconds"
+        )
+
+
+_lock = threading.Lock()
+_budgets: dict[str, RetryBudget] = {}
+_hedge_budgets: dict[str, RetryBudget] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_retry_budget(hostname: str) -> RetryBudget:
+    with _lock:
+        budget = _budgets.get(hostname, None)
+
+        if budget is None:
+            budget = RetryBudget(hostname)
+            _budgets[hostname] = budget
+
+        return budget
+
+
+def get_hedge_budget(hostname: str) -> RetryBudget:
+    with _lock:
+        budget = _hedge_budgets.get(hostname, None)
+
+        if budget is None:
+            budget = RetryBudget(
+                hostname, RetryConfig.hedge_ratio, RetryConfig.hedge_min, RetryConfig.hedge_max
+            )
+            _hedge_budgets[hostname] = budget
+
+        return budget
+
+
+def get_breaker(hostname: str) -> CircuitBreaker:
+    with _lock:
+        breaker = _breakers.get(hostname, None)
+
+        if breaker is None:
+            breaker = CircuitBreaker(hostname)
+            _breakers[hostname] = breaker
+
+        return breaker
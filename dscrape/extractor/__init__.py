@@ -13,8 +13,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .common import CourseScraper
+from .common import CourseScraper, AsyncCourseScraper
+from . import batchPlanner
 from .myCampus import (
+    DumperConfig,
+    AsyncCourseDumper,
     UOIT_Dumper,
     UVIC_Dumper,
     TTU_Dumper,
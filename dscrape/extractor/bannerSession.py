@@ -0,0 +1,106 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import httpx
+
+from .. import dataUtil as DU
+
+import logging
+
+"""
+Banner keeps the selected term in the server side session (the cookie jar),
+searchResults only returns data for the term the session was last bound to with term/search.
+
+This tracks what the session is bound to, so we only send the auth requests when something changed
+instead of before every request.
+"""
+
+# banner drops idle sessions, so auth and term bindings are refreshed after this long
+SESSION_TTL_SECONDS = 300 * 2
+
+# the paths banner redirects to when it no longer knows the session
+REJECTED_SESSION_PATHS = ("termSelection", "login", "registration")
+
+
+class BannerSession:
+    def __init__(self, client: httpx.Client | httpx.AsyncClient, ttl: int = SESSION_TTL_SECONDS) -> None:
+        self.client = client
+        self.ttl = ttl
+
+        self.authed_at : int = 0
+
+        self.term : str = None
+        self.bound_at : int = 0
+
+    def __repr__(self) -> str:
+        return f"<BannerSession term={self.term}>"
+
+    def needs_auth(self):
+        return DU.time_has_passed(self.authed_at + self.ttl)
+
+    def needs_term(self, term_id: str):
+        return self.needs_auth() or self.term != str(term_id) or DU.time_has_passed(self.bound_at + self.ttl)
+
+    def mark_authed(self):
+        self.authed_at = DU.time_now_int()
+
+        # a new auth starts from a fresh search form
+        self.term = None
+
+    def mark_bound(self, term_id: str):
+        self.term = str(term_id)
+        self.bound_at = DU.time_now_int()
+
+    def invalidate(self):
+        """
+        Forget everything about the session, the next request will auth and bind again
+        """
+        logging.debug(f"Invalidating {self}")
+
+        self.authed_at = 0
+        self.term = None
+        self.bound_at = 0
+
+    def is_rejected(self, response: httpx.Response):
+        """
+        Checks if banner refused the request because it does not know the session
+        """
+        if response is None:
+            return False
+
+        if response.status_code in (401, 403):
+            return True
+
+        # httpx does not follow redirects unless asked to, so check both the redirect itself
+        # and where we ended up if it was followed
+        if response.is_redirect:
+            location = response.headers.get("Location", "")
+
+            return any(i in location for i in REJECTED_SESSION_PATHS)
+
+        if response.history and any(i in response.url.path for i in REJECTED_SESSION_PATHS):
+            return True
+
+        return False
+
+    def accepts(self, response: httpx.Response):
+        """
+        Checks if banner answered the auth or term search request, redirects that are not
+        rejections are fine since those pages only set up the session
+        """
+        if response is None or response.status_code >= 400:
+            return False
+
+        return not self.is_rejected(response)
@@ -0,0 +1,473 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import threading
+import urllib.parse
+from collections import deque
+
+import logging
+
+"""
+Plans which course codes go into each searchResults request.
+
+Banner drops any url longer than about 8000 characters and never returns more than 500 sections.
+
+When the previous scrape tells us how many sections every course has, the course codes are bin packed
+so each request lands just under the section limit. Otherwise a batch is packed with as many course
+codes as fit in the url, up to the batch size learned for the school and term. That size is halved
+when a batch is truncated and grows a little after every complete batch, and it is saved to a json
+file so the next run starts from it.
+"""
+
+
+class PlannerConfig:
+    # the server drops urls longer than about 8000 characters, leave some room for error
+    max_url_length = 7500
+
+    # where the learned batch sizes are kept between runs
+    state_path = "./batch_sizes.json"
+
+    # sections to aim for per request when packing by section count, the api stops at 500
+    # and courses gain sections between scrapes, so leave some room
+    section_target = 450
+
+    # the batch size of a term nothing was learned about yet, what every request used to have
+    default_batch_size = 150
+
+    # course codes a batch size grows by after a complete batch of that size
+    batch_size_step = 10
+
+
+# separator between course codes in the txt_subjectcoursecombo parameter
+CODE_SEPARATOR = "%2C"
+
+
+def encoded_code_length(code: str):
+    return len(urllib.parse.quote(code.upper(), safe=""))
+
+
+class LearnedSize:
+    """
+    The batch size for a single school and term, halved when a batch is truncated
+    and grown by PlannerConfig.batch_size_step after a complete one
+    """
+
+    def __init__(self, size: int = None) -> None:
+        # the most course codes a batch should have
+        self.size = size or PlannerConfig.default_batch_size
+
+        # the smallest batch that hit the result limit in this run, growing stops just under it.
+        # it is not saved, the sections of a term change between runs
+        self.smallest_truncated: int = None
+
+    def __repr__(self) -> str:
+        return f"<LearnedSize size={self.size} truncated={self.smallest_truncated}>"
+
+    def limit(self):
+        """
+        The most course codes a batch should have
+        """
+        return self.size
+
+    def record_ok(self, batch_size: int):
+        if batch_size < self.size:
+            # the url or the end of the course codes cut it short, it says nothing about the size
+            return
+
+        size = self.size + PlannerConfig.batch_size_step
+
+        if self.smallest_truncated is not None:
+            size = min(size, self.smallest_truncated - 1)
+
+        self.size = max(self.size, size)
+
+    def record_truncated(self, batch_size: int):
+        if self.smallest_truncated is None or batch_size < self.smallest_truncated:
+            self.smallest_truncated = batch_size
+
+        self.size = max(1, min(self.size, batch_size // 2))
+
+    def to_json(self):
+        return {"size": self.size}
+
+    @staticmethod
+    def from_json(j: dict):
+        return LearnedSize(int(j.get("size", 0)) or None)
+
+
+_lock = threading.Lock()
+_loaded = False
+
+# school key -> term -> size, see get_school_key
+_learned: dict[str, dict[str, LearnedSize]] = {}
+
+
+def configure(state_path: str = None):
+    global _loaded
+
+    if state_path is not None:
+        PlannerConfig.state_path = state_path
+
+    with _lock:
+        _loaded = False
+        _learned.clear()
+
+
+def _load():
+    global _loaded
+
+    if _loaded:
+        return
+
+    _loaded = True
+
+    if not os.path.isfile(PlannerConfig.state_path):
+        return
+
+    try:
+        with open(PlannerConfig.state_path, "r") as reader:
+            j = json.load(reader)
+
+        for school, terms in j.items():
+            _learned[school] = {term: LearnedSize.from_json(i) for term, i in terms.items()}
+
+        logging.info(f"Loaded learned batch sizes from {PlannerConfig.state_path}")
+
+    except (OSError, ValueError, AttributeError) as e:
+        logging.warning(f"Could not read learned batch sizes from {PlannerConfig.state_path}: {e}")
+
+
+def get_school_key(hostname: str, mep_code: str = ""):
+    """
+    Schools on the same host (UOIT and DC are both on ssp.mycampus.ca) have their own terms,
+    so the sizes are kept per host and mep code
+    """
+    if not mep_code:
+        return hostname
+
+    return f"{hostname}/{mep_code}"
+
+
+def get_learned_size(hostname: str, mep_code: str, term_id: str) -> LearnedSize:
+    with _lock:
+        _load()
+
+        terms = _learned.setdefault(get_school_key(hostname, mep_code), {})
+        learned = terms.get(str(term_id), None)
+
+        if learned is None:
+            learned = LearnedSize()
+            terms[str(term_id)] = learned
+
+        return learned
+
+
+def save_learned_sizes():
+    with _lock:
+        if not _loaded:
+            return
+
+        j = {school: {term: i.to_json() for term, i in terms.items()} for school, terms in _learned.items()}
+
+    try:
+        with open(PlannerConfig.state_path, "w") as writer:
+            json.dump(j, writer, indent=3)
+
+    except OSError as e:
+        logging.warning(f"Could not save learned batch sizes to {PlannerConfig.state_path}: {e}")
+
+
+class BatchPlanner:
+    """
+    Plans the searchResults requests for the course codes of a single term
+
+    base_url_length is the length of the request url without any course codes in it,
+    section_counts maps a course code to how many sections it had in the previous scrape
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        mep_code: str,
+        term_id: str,
+        base_url_length: int,
+        section_counts: dict[str, int] = None,
+    ) -> None:
+        self.hostname = hostname
+        self.term_id = str(term_id)
+        self.base_url_length = base_url_length
+        self.section_counts = section_counts or {}
+
+        self.learned = get_learned_size(hostname, mep_code, term_id)
+
+        # the size the batches that are left were packed with
+        self.planned_limit: int = None
+
+        # failed requests per batch, a bisected batch starts with what its parent had
+        self.failures: dict[tuple[str, ...], int] = {}
+        self.bisected: set[tuple[str, ...]] = set()
+
+        # the other half of every bisected batch, and the halves that came back complete
+        # or ran out of retries, only one half failing means the course codes are at fault
+        self.siblings: dict[tuple[str, ...], tuple[str, ...]] = {}
+        self.complete: set[tuple[str, ...]] = set()
+        self.exhausted: set[tuple[str, ...]] = set()
+
+        # batches that came back complete, and how many had when both halves of a batch failed.
+        # halves that fail again after other batches went through are split on their own
+        self.complete_count = 0
+        self.both_failed: dict[tuple[str, ...], int] = {}
+        self.suspects: set[tuple[str, ...]] = set()
+
+    def __repr__(self) -> str:
+        return f"<BatchPlanner {self.hostname} {self.term_id} {self.learned}>"
+
+    def plan(self, course_codes: list[str]) -> deque[list[str]]:
+        """
+        Splits the course codes into the batches to request, in the order they should be sent
+        """
+        if self.section_counts:
+            batches = self._plan_by_sections(course_codes)
+        else:
+            batches = self._plan_by_count(course_codes)
+
+        logging.info(
+            f"Planned {len(batches)} course data requests for {len(course_codes)} course codes in term {self.term_id}"
+        )
+
+        return batches
+
+    def _plan_by_count(self, course_codes: list[str]):
+        batches = deque()
+        start = 0
+
+        self.planned_limit = self.learned.limit()
+
+        while start < len(course_codes):
+            batch = self.next_batch(course_codes, start)
+            batches.append(batch)
+            start += len(batch)
+
+        return batches
+
+    def _plan_by_sections(self, course_codes: list[str]):
+        known = [self.section_counts[i] for i in course_codes if i in self.section_counts]
+
+        # courses that are new since the last scrape are guessed to be average sized
+        guess = max(1, round(sum(known) / len(known))) if known else 1
+
+        weights = {i: self.section_counts.get(i, guess) for i in course_codes}
+
+        # first fit decreasing, every bin is [sections, url length, course codes]
+        bins = []
+
+        for code in sorted(course_codes, key=lambda i: weights[i], reverse=True):
+            weight = weights[code]
+            added = encoded_code_length(code)
+
+            for b in bins:
+                if (
+                    b[0] + weight <= PlannerConfig.section_target
+                    and b[1] + len(CODE_SEPARATOR) + added <= PlannerConfig.max_url_length
+                ):
+                    b[0] += weight
+                    b[1] += len(CODE_SEPARATOR) + added
+                    b[2].append(code)
+                    break
+
+            else:
+                bins.append([weight, self.base_url_length + added, [code]])
+
+        return deque(b[2] for b in bins)
+
+    def next_batch(self, course_codes: list[str], start: int):
+        """
+        Returns the longest run of course codes from start that fits in a single request
+        """
+        limit = self.learned.limit()
+        length = self.base_url_length
+        end = start
+
+        while end < len(course_codes):
+            if end - start >= limit:
+                break
+
+            added = encoded_code_length(course_codes[end])
+
+            if end > start:
+                added += len(CODE_SEPARATOR)
+
+            # always send at least one code, even if it is somehow too long by itself
+            if end > start and length + added > PlannerConfig.max_url_length:
+                break
+
+            length += added
+            end += 1
+
+        return course_codes[start:end]
+
+    def record_ok(self, batch: list[str]):
+        self.complete_count += 1
+
+        if self.is_bisected(batch):
+            self.complete.add(tuple(batch))
+
+        if self.section_counts:
+            return
+
+        with _lock:
+            self.learned.record_ok(len(batch))
+
+    def replan(self, batches: deque[list[str]]):
+        """
+        Packs the batches that are left again when the learned size grew since they were planned
+        """
+        if self.section_counts or any(self.is_bisected(i) for i in batches):
+            # bisected batches are finished before packing again
+            return
+
+        if self.learned.limit() <= self.planned_limit:
+            return
+
+        remaining = [i for b in batches for i in b]
+        batches.clear()
+        batches.extend(self._plan_by_count(remaining))
+
+    def record_truncated(self, batches: deque[list[str]]):
+        """
+        The first of the batches hit the result limit, replaces it with smaller ones
+        """
+        batch = batches.popleft()
+
+        if self.section_counts:
+            # the counts were off for this batch only, the rest of the plan is still good
+            self._split(batch, batches)
+
+            logging.info(f"Split a truncated batch of {len(batch)} course codes: {self}")
+
+            return
+
+        with _lock:
+            self.learned.record_truncated(len(batch))
+
+        logging.info(f"Learned a smaller batch size: {self}")
+
+        # every batch was packed to the old limit, so plan what is left again
+        remaining = batch + [i for b in batches for i in b]
+        batches.clear()
+        batches.extend(self._plan_by_count(remaining))
+
+    def _split(self, batch: list[str], batches: deque[list[str]]):
+        half = len(batch) // 2
+
+        batches.appendleft(batch[half:])
+        batches.appendleft(batch[:half])
+
+    def record_failure(self, batch: list[str]):
+        key = tuple(batch)
+        self.failures[key] = self.failures.get(key, 0) + 1
+
+    def get_failures(self, batch: list[str]):
+        return self.failures.get(tuple(batch), 0)
+
+    def is_bisected(self, batch: list[str]):
+        """
+        If the batch is half of a batch that kept failing
+        """
+        return tuple(batch) in self.bisected
+
+    def bisect(self, batches: deque[list[str]]):
+        """
+        The first of the batches keeps failing, replaces it with its two halves so the
+        half that works can go through and the other one can be split again
+        """
+        batch = batches.popleft()
+        failures = self.failures.pop(tuple(batch), 0)
+
+        self._split(batch, batches)
+
+        for i in (batches[0], batches[1]):
+            self.failures[tuple(i)] = failures
+            self.bisected.add(tuple(i))
+
+        self.siblings[tuple(batches[0])] = tuple(batches[1])
+        self.siblings[tuple(batches[1])] = tuple(batches[0])
+
+    def sibling_complete(self, batch: list[str]):
+        return self.siblings.get(tuple(batch), None) in self.complete
+
+    def sibling_exhausted(self, batch: list[str]):
+        return self.siblings.get(tuple(batch), None) in self.exhausted
+
+    def is_suspect(self, batch: list[str]):
+        return tuple(batch) in self.suspects
+
+    def is_culprit(self, batch: list[str]):
+        """
+        If the batch ran out of retries and has to be split, because its other half came back
+        complete or both halves failed again after other batches went through
+        """
+        if tuple(batch) not in self.exhausted:
+            return False
+
+        return self.sibling_complete(batch) or self.is_suspect(batch)
+
+    def defer(self, batches: deque[list[str]]):
+        """
+        The first of the batches is a half that ran out of retries before its other half was tried,
+        moves it after the other half, which tells if the course codes are at fault
+        """
+        batch = batches.popleft()
+        sibling = list(self.siblings[tuple(batch)])
+
+        self.exhausted.add(tuple(batch))
+
+        batches.insert(batches.index(sibling) + 1, batch)
+
+    def others_completed(self, batch: list[str]):
+        """
+        If other batches came back complete since both halves of the batch failed the last time
+        """
+        failed_at = self.both_failed.get(tuple(batch), None)
+
+        return failed_at is not None and self.complete_count > failed_at
+
+    def suspect_halves(self, batch: list[str]):
+        """
+        Both halves failed again while the rest of the term went through, so each holds
+        a course code that fails, they are split on their own
+        """
+        self.suspects.add(tuple(batch))
+        self.suspects.add(self.siblings[tuple(batch)])
+
+    def requeue_halves(self, batches: deque[list[str]]):
+        """
+        Both halves of a batch failed, the first of the batches is one of them.
+        Moves them after every other batch so those show if the host is failing for everything
+        """
+        batch = batches.popleft()
+        sibling = list(self.siblings[tuple(batch)])
+
+        if sibling in batches:
+            batches.remove(sibling)
+
+        batches.append(batch)
+        batches.append(sibling)
+
+        for i in (tuple(batch), tuple(sibling)):
+            self.exhausted.discard(i)
+            self.both_failed[i] = self.complete_count
@@ -30,3 +30,19 @@ class CourseScraper(requester.Requester):
         Fetches all the data the current scraper can get and writes it to the database
         """
         raise RuntimeError("CourseScraper.scrape_and_dump is abstract and cannot be called")
+
+
+class AsyncCourseScraper(requester.AsyncRequester):
+    """
+    Base class for all asyncio course scrapers
+    """
+
+    SCHOOL_VALUE: str = None
+    SUBDOMAIN: str = None
+    TIMEZONE: str = None
+
+    async def scrape_and_dump(self, debug_break_1: bool = False):
+        """
+        Fetches all the data the current scraper can get and writes it to the database
+        """
+        raise RuntimeError("AsyncCourseScraper.scrape_and_dump is abstract and cannot be called")
@@ -14,15 +14,24 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import queue
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from bs4 import BeautifulSoup
 import re
 from datetime import datetime
 
-from .common import CourseScraper
+from .common import CourseScraper, AsyncCourseScraper
+from .bannerSession import BannerSession
+from .batchPlanner import BatchPlanner
+from .prefetch import prefetch, aprefetch
 
-from .. import dataUtil as DU
 from .. import database
+from .. import metrics
+from .. import pipeline
+from ..downloader import resilience
 
 import logging
 
@@ -51,25 +60,318 @@ COURSE_CODES_GET_URL = "https://{HOST}/StudentRegistrationSsb/ssb/classSearch/ge
 
 COURSE_DATA_GET_URL = "https://{HOST}/StudentRegistrationSsb/ssb/searchResults/searchResults?mepCode={MEP_CODE}&txt_term={TERM_ID}&txt_subjectcoursecombo={COURSE_CODES}&pageMaxSize={MAX_COUNT}"
 
+# endpoint types, latency and timeouts are tracked separately for each of them
+ENDPOINT_AUTH = "auth"
+ENDPOINT_TERM_SEARCH = "term_search"
+ENDPOINT_TERMS = "terms"
+ENDPOINT_COURSE_CODES = "course_codes"
+ENDPOINT_COURSE_DATA = "course_data"
+ENDPOINT_RESTRICTIONS = "restrictions"
 
-# there is a max length URI allowed by the api,
-# this keeps the number of course codes in the url to this number
-# i haven't tested above 500, but my thought is upper limit of 1200 would be fine
-# this would double the speed because it would half the requests, higher this is the better
-# UPDATE: 1000 is too long, must be lower than that
-# NOTE: url should be less than 8000 characters, otherwise server will drop it
-COURSE_CODE_REQUEST_AMOUNT = 150
+
+class DumperConfig:
+    # send a duplicate searchResults request when one is slower than the host's p95
+    hedge_course_data = False
+
+    # independent banner sessions per dumper, each one can scrape a different term at the same time
+    term_sessions = 2
+
+    # retries for each half of a course data batch that kept failing, the whole batch
+    # already failed so there is no point in trying the halves as often
+    bisect_retries = 1
+
+    # course data batches to download ahead of the one being written to the database, 0 turns it off
+    prefetch_depth = 0
 
 
 MATCHES_RESTRICTION_GROUP = re.compile(r"^(must|cannot)\s*be.*following\s*([^:]+):?$", re.IGNORECASE)
 MATCHES_RESTRICTION_SPECIAL = re.compile(r"^special approvals:$", re.IGNORECASE)
 
 
-class CourseDumper(CourseScraper):
+def parse_restrictions(content: bytes):
+    """
+    Parses the html returned by the getRestrictions endpoint into groups of restrictions
+    """
+    page = BeautifulSoup(content, "html.parser")
+    spans = page.find_all("span")
+
+    restrictions = {}
+    current = None
+    must_be_in = False
+    for i in spans:
+        m = MATCHES_RESTRICTION_GROUP.match(i.text)
+
+        if m:
+            must_be_in = m.group(1).lower() == "must"
+            group = m.group(2).lower()
+
+            if group in restrictions:
+                current = restrictions[group]
+
+            else:
+                current = []
+                restrictions[group] = current
+
+        elif MATCHES_RESTRICTION_SPECIAL.match(i.text):
+            s = "special"
+            if s in restrictions:
+                current = restrictions[s]
+            else:
+                current = []
+                restrictions[s] = current
+
+        elif current is not None and "detail-popup-indentation" in i["class"]:
+            current.append({"value": i.text, "must_be_in": must_be_in})
+        else:
+            if i.text == "Not all restrictions are applicable.":
+                continue
+            logging.warn(f"Unknown span while parsing restrictions: {i}")
+
+    return restrictions
+
+
+class CourseDataFetch:
+    """
+    The batching, retry and bisection decisions for downloading one term's course data,
+    the sync and async dumpers only send the requests
+    """
+
+    # api only returns at most 500 course datas
+    API_COURSE_DATAS_LIMIT = 500
+
+    def __init__(
+        self,
+        dumper: "CourseDumperBase",
+        term_id: str,
+        course_codes: list[str],
+        max_count: int,
+        retry_amount: int,
+        section_counts: dict[str, int],
+        session: BannerSession,
+    ) -> None:
+        self.dumper = dumper
+        self.session = session
+        self.term_id = term_id
+        self.max_count = max_count
+        self.retry_amount = retry_amount
+
+        # failures that are not about the course codes, too many of these give up on the term
+        self.retries = 0
+
+        # failures of the current batch, too many of these bisect it
+        self.batch_failures = 0
+
+        # packs the course codes so every request stays under API_COURSE_DATAS_LIMIT
+        self.planner = BatchPlanner(
+            dumper.hostname,
+            dumper.mep_code,
+            term_id,
+            len(dumper.course_data_url(term_id, [], max_count)),
+            section_counts,
+        )
+
+        self.batches = self.planner.plan(course_codes)
+        self.sublist: list[str] = None
+
+    def next_batch(self):
+        """
+        The course codes to request next, None once every batch is done or the term was given up on
+        """
+        while self.batches:
+            if self.retries > self.retry_amount:
+                logging.error(
+                    f"Max retries exceeded while trying to get course_data for term {self.term_id}"
+                )
+
+                self.dumper.incomplete_terms.add(str(self.term_id))
+
+                if self.sublist:
+                    logging.error(f"Sublist of course codes was: {self.sublist}")
+
+                return None
+
+            # the batch size grows after complete batches, pack what is left with the new one
+            self.planner.replan(self.batches)
+
+            self.sublist = self.batches[0]
+
+            if self.batch_failures > self.batch_retry_amount() or self.planner.is_culprit(
+                self.sublist
+            ):
+                self.isolate_failed_batch()
+                self.batch_failures = 0
+                continue
+
+            logging.debug(f"Fetching course datas for {len(self.sublist)} course codes")
+
+            return self.sublist
+
+        return None
+
+    def url(self):
+        return self.dumper.course_data_url(self.term_id, self.sublist, self.max_count)
+
+    def batch_retry_amount(self):
+        if self.planner.is_bisected(self.sublist):
+            return DumperConfig.bisect_retries
+
+        return self.retry_amount
+
+    def isolate_failed_batch(self):
+        """
+        The current batch failed too many times, bisects it or quarantines
+        it when it is down to a single course code
+
+        A half of a bisected batch is only split further when the other half came back complete.
+        If both failed the host or the session is the likely cause, the session is bound again
+        and the halves are sent after the rest of the term. When they fail again after other batches
+        went through, each half holds a course code that fails and both are split
+        """
+        log_prefix = self.dumper.log_prefix
+        sublist = self.sublist
+
+        if (
+            self.planner.is_bisected(sublist)
+            and not self.planner.sibling_complete(sublist)
+            and not self.planner.is_suspect(sublist)
+        ):
+            if not self.planner.sibling_exhausted(sublist):
+                # the other half tells if these course codes are at fault
+                self.planner.defer(self.batches)
+                return
+
+            if not self.planner.others_completed(sublist):
+                logging.warning(
+                    f"{log_prefix} Both halves of a batch keep failing in term {self.term_id}\nRetrying with a new session..."
+                )
+                self.planner.requeue_halves(self.batches)
+                self.session.invalidate()
+                self.retries += 1
+                return
+
+            self.planner.suspect_halves(sublist)
+
+        if len(self.sublist) > 1:
+            logging.warning(
+                f"{log_prefix} Batch of {len(self.sublist)} course codes keeps failing in term {self.term_id}, bisecting it"
+            )
+            metrics.increment("course_data.bisections")
+            self.planner.bisect(self.batches)
+            return
+
+        self.batches.popleft()
+
+        self.dumper.incomplete_terms.add(str(self.term_id))
+
+        cost = self.planner.get_failures(self.sublist)
+
+        logging.error(
+            f"{log_prefix} Quarantining course {self.sublist[0]} in term {self.term_id} after {cost} failed requests"
+        )
+        metrics.record_quarantine(self.dumper.hostname, self.term_id, self.sublist[0], cost)
+
+    def bind_failed(self):
+        logging.warning(
+            f"{self.dumper.log_prefix} Could not bind session to term {self.term_id}\nRetrying..."
+        )
+        self.retries += 1
+
+    def batch_failed(self):
+        self.planner.record_failure(self.sublist)
+        metrics.increment("course_data.failed_requests")
+        self.batch_failures += 1
+
+    def read_response(self, r):
+        """
+        Returns the json of a complete response for the current batch and moves on to the next one,
+        None if there is nothing to hand on, either because the batch has to be requested again
+        or because its course codes have no sections in the term
+        """
+        log_prefix = self.dumper.log_prefix
+        session = self.session
+
+        if r is None:
+            logging.warning(f"{log_prefix} get_json_course_data got None response\nRetrying...")
+            self.retries += 1
+            return None
+
+        if session.is_rejected(r):
+            logging.warning(f"{log_prefix} Session was rejected, binding it again\nRetrying...")
+            session.invalidate()
+            self.retries += 1
+            return None
+
+        if r.status_code != 200:
+            logging.warning(
+                f"{log_prefix} get_json_course_data got status code {r.status_code} with reason: {r.reason_phrase}\nRetrying..."
+            )
+            self.batch_failed()
+            return None
+
+        try:
+            j = r.json()
+        except json.JSONDecodeError:
+            logging.warning("Did not get valid json response! Retrying...")
+            self.batch_failed()
+            return None
+
+        data = j.get("data", None)
+
+        if not data and j.get("totalCount", None) == 0:
+            # the course codes really have no sections in this term
+            logging.debug(f"{log_prefix} No sections for {len(self.sublist)} course codes in term {self.term_id}")
+            self.planner.record_ok(self.sublist)
+            self.batch_done()
+            return None
+
+        if not data:
+            # banner answers with no data when the session lost its term, that is not the course codes
+            logging.warning(
+                f"Got json response for course data but no data??? {j}\nRebinding session and retrying..."
+            )
+            session.invalidate()
+            self.retries += 1
+            return None
+
+        if len(data) >= self.API_COURSE_DATAS_LIMIT:
+            if len(self.sublist) == 1:
+                # nothing smaller to send, keep what the api gave us
+                logging.error(
+                    f"{log_prefix} Course {self.sublist[0]} alone has more than {self.API_COURSE_DATAS_LIMIT} course datas, some are missing"
+                )
+
+            else:
+                self.planner.record_truncated(self.batches)
+                logging.warning(
+                    f"Got {self.API_COURSE_DATAS_LIMIT} course datas for {len(self.sublist)} course codes, which is the known api truncation point, retrying with a smaller batch..."
+                )
+
+                return None
+
+        else:
+            self.planner.record_ok(self.sublist)
+
+        self.batch_done()
+
+        return j
+
+    def batch_done(self):
+        self.batches.popleft()
+        self.batch_failures = 0
+
+
+class CourseDumperBase:
+    """
+    State and parsing shared by the sync and async Banner dumpers
+    """
+
+    HOSTNAME: str = None
+    MEP_CODE: str = None
+
     def __init__(
         self,
-        hostname: str,
-        mep_code: str,
+        hostname: str = None,
+        mep_code: str = None,
         retries=5,
         timeout=DEFAULT_TIMEOUT,
     ) -> None:
@@ -80,235 +382,302 @@ class CourseDumper(CourseScraper):
 
         self.school_id = None
 
-        self.hostname = hostname
+        self.hostname = hostname or self.HOSTNAME
 
-        self.mep_code = mep_code
+        self.mep_code = self.MEP_CODE if mep_code is None else mep_code
 
         self.term_auth_url = TERM_AUTH_URL.format(HOST=self.hostname, MEP_CODE=self.mep_code)
 
         self.auth_timeout_seconds = 300 * 2
-        self.auth_hist = {
-            "terms": 0,
-        }
 
-        self.log_prefix = f"Requester {self.hostname}:"
+        # banner binds a session to a single term, so every term that is scraped
+        # at the same time needs its own session (and cookie jar)
+        self.banner_session = BannerSession(self.session, self.auth_timeout_seconds)
+        self.banner_sessions = [self.banner_session] + [
+            BannerSession(self.create_session(), self.auth_timeout_seconds)
+            for _ in range(DumperConfig.term_sessions - 1)
+        ]
 
-    def auth_terms(self, force: bool = False):
-        if (
-            not DU.time_has_passed(self.auth_hist["terms"] + self.auth_timeout_seconds)
-            and not force
-        ):
-            return
+        self.log_prefix = f"Requester {self.hostname}:"
 
-        logging.info(f"{self.log_prefix} Refreshing terms auth")
+        # terms that were not scraped completely, by real term id, their old data is not deleted
+        self.incomplete_terms: set[str] = set()
 
-        self.request("get", self.term_auth_url, timeout=self.auth_timeout_seconds)
+        # the internal term ids of every term that was scraped completely
+        self.completed_term_ids: list[int] = []
 
-        self.auth_hist["terms"] = DU.time_now_int()
+    def get_terms_to_scrape(self, real_term_id: list[str], internal_term_ids: list[int], debug_break_1=False):
+        terms = list(zip(real_term_id, internal_term_ids))
 
-    def get_json_terms(self, max_count: int = MAX_COUNT):
-        self.auth_terms()
+        if debug_break_1:
+            return terms[:1]
 
-        url = TERM_SEARCH_GET_URL.format(HOST=self.hostname, MAX_COUNT=max_count)
+        return terms
 
-        r = self.request("get", url)
+    def term_search_url(self, term_id: str):
+        return TERM_SEARCH_AUTH_URL.format(HOST=self.hostname, TERM=term_id)
 
-        if r.status_code == 200:
-            return r.json()
+    def terms_url(self, max_count: int = MAX_COUNT):
+        return TERM_SEARCH_GET_URL.format(HOST=self.hostname, MAX_COUNT=max_count)
 
-        logging.warning(
-            f"{self.log_prefix} get_json_terms got status code {r.status_code} with reason: {r.reason_phrase}"
+    def course_codes_url(self, term_id: str, search_code: str = "", max_count: int = MAX_COUNT):
+        return COURSE_CODES_GET_URL.format(
+            HOST=self.hostname, SEARCH=search_code, TERM_ID=term_id, MAX_COUNT=max_count
         )
-        logging.warning(r)
-        logging.warning(r.text)
 
-        return {}
+    def restrictions_url(self, term: int, crn: int):
+        return TERM_SEARCH_GET_RESTRICTION.format(HOST=self.hostname, TERM=term, CRN=crn)
 
-    def get_json_course_codes(
-        self, term_id: str, search_code: str = "", max_count: int = MAX_COUNT
-    ):
-        self.auth_terms()
+    def filter_current_terms(self, terms: list[dict]):
+        """
+        Returns the (code, description) of every term from last year onwards
+        """
+        currentYear = (datetime.now().year - 1) * 100
+        logging.info(f"Current term year: {currentYear}")
 
-        url = COURSE_CODES_GET_URL.format(
-            HOST=self.hostname, SEARCH=search_code, TERM_ID=term_id, MAX_COUNT=max_count
+        return list(
+            filter(
+                lambda x: int(x[0]) >= currentYear, [(i["code"], i["description"]) for i in terms]
+            )
         )
 
-        r = self.request("get", url)
+    def split_current_terms(self, terms: list[dict]):
+        """
+        Returns the real term ids and descriptions of every term from last year onwards
+        """
+        real_term_id_and_desc = self.filter_current_terms(terms)
+
+        real_term_id = [i[0] for i in real_term_id_and_desc]
+        term_desc = [i[1] for i in real_term_id_and_desc]
+
+        return real_term_id, term_desc
+
+    def split_course_codes(self, real_id: str, course_codes: list[dict]):
+        """
+        Returns the codes and descriptions of the term's courses, a term without any is incomplete
+        """
+        if not course_codes:
+            logging.warning(f"{self.log_prefix} Got no course codes for term {real_id}")
+            self.incomplete_terms.add(str(real_id))
+
+        course_code = [i["code"] for i in course_codes]
+        course_desc = [i["description"] for i in course_codes]
+
+        return course_code, course_desc
 
+    def course_data_url(self, term_id: str, sublist: list[str], max_count: int = MAX_COUNT):
+        course_codes_request = "%2C".join(code.upper() for code in sublist)
+
+        return COURSE_DATA_GET_URL.format(
+            HOST=self.hostname,
+            MEP_CODE=self.mep_code,
+            TERM_ID=term_id,
+            COURSE_CODES=course_codes_request,
+            MAX_COUNT=max_count,
+        )
+
+    def read_json(self, r, name: str):
+        """
+        The json of the response, {} if there was none or it was not a 200
+        """
         if r is None:
-            logging.warning(
-                f"{self.log_prefix} get_json_course_codes got None response."
-            )
+            logging.warning(f"{self.log_prefix} {name} got None response.")
             return {}
 
-
         if r.status_code == 200:
             return r.json()
 
         logging.warning(
-            f"{self.log_prefix} get_json_course_codes got status code {r.status_code} with reason: {r.reason_phrase}"
+            f"{self.log_prefix} {name} got status code {r.status_code} with reason: {r.reason_phrase}"
         )
+        logging.debug(r.text)
 
         return {}
 
-    def get_json_course_data(
-        self,
-        term_id: str,
-        course_codes: list[str] = None,
-        max_count: int = MAX_COUNT,
-        retry_amount=5,
-    ):
-        self.auth_terms()
+    def read_restrictions(self, r):
+        if r is None:
+            logging.warning(f"{self.log_prefix} get_course_restrictions got None response.")
+            return {"levels": [], "degrees": []}
+
+        if r.status_code != 200:
+            return {"levels": [], "degrees": []}
 
-        # api only returns at most 500 course datas
-        API_COURSE_DATAS_LIMIT = 500
+        return parse_restrictions(r.content)
 
-        retries = 0
-        course_code_count = len(course_codes)
-        course_code_send_amount = COURSE_CODE_REQUEST_AMOUNT
+    def read_auth(self, r, session: BannerSession):
+        """
+        Marks the session as authed if the term selection was accepted
+        """
+        if not session.accepts(r):
+            logging.warning(f"{self.log_prefix} Terms auth was not accepted")
+            session.invalidate()
+            return False
 
-        sent_course_codes = 0
+        session.mark_authed()
 
-        while sent_course_codes < course_code_count:
+        return True
 
-            if retries > retry_amount:
+    def read_bound_term(self, r, term_id: str, session: BannerSession):
+        """
+        Marks the session as bound to the term if the term search was accepted
+        """
+        if not session.accepts(r):
+            session.invalidate()
+            return False
 
-                logging.error(f"Max retries exceeded while trying to get course_data for term {term_id}")
-                
-                if sublist:
-                    logging.error(f"Sublist of course codes was: {sublist}")
+        session.mark_bound(term_id)
 
-                return {}
+        return True
 
-            sublist = course_codes[sent_course_codes : sent_course_codes + course_code_send_amount]
+    def log_term_failure(self, real_id: str, e: Exception):
+        logging.error(f"{self.log_prefix} Failed to scrape term {real_id}")
+        logging.error(e)
+        logging.error(traceback.format_exc())
 
-            if not sublist:
-                logging.warning(
-                    f"Course code sublist is empty??? sent_course_codes: {sent_course_codes}, course_codes_count: {course_code_count}"
-                )
-                retries += 1
-                continue
+    def term_writes(self, real_id: str, internal_id: int):
+        """
+        The writes of a term, it is marked done once every one of them is in the database
+        """
+        return pipeline.WriteGroup(
+            f"{self.log_prefix} term {real_id}", lambda: self.mark_term_done(real_id, internal_id)
+        )
 
-            logging.debug(f"Fetching course datas for {len(sublist)} course codes")
+    def mark_term_done(self, real_id: str, internal_id: int):
+        if str(real_id) in self.incomplete_terms:
+            logging.warning(f"{self.log_prefix} Term {real_id} is incomplete, its old data will be kept")
+            return
 
-            course_codes_request = "%2C".join(code.upper() for code in sublist)
+        self.completed_term_ids.append(internal_id)
 
-            self.session.get(
-                url=TERM_SEARCH_AUTH_URL.format(HOST=self.hostname, TERM=term_id),
-            )
+    def map_course_ids(self, course_code: list[str], course_ids: list[int], course_data: list[dict]):
+        # NOTE: assuming course_code and course_ids are in order (they should be), this works fine
+        #       otherwise we probably need to query the db for every course data we insert
+        course_id_map = {code: j for code, j in zip(course_code, course_ids)}
 
-            url = COURSE_DATA_GET_URL.format(
-                HOST=self.hostname,
-                MEP_CODE=self.mep_code,
-                TERM_ID=term_id,
-                COURSE_CODES=course_codes_request,
-                MAX_COUNT=max_count,
-            )
+        return [course_id_map[i["subjectCourse"]] for i in course_data]
 
-            r = self.request("get", url)
 
-            if r is None:
-                logging.warning(
-                    f"{self.log_prefix} get_json_course_data got None response\nRetrying..."
-                )
-                retries += 1
-                continue
+class CourseDumper(CourseDumperBase, CourseScraper):
+    def auth_terms(self, force: bool = False, session: BannerSession = None):
+        session = session or self.banner_session
 
-            if r.status_code != 200:
-                logging.warning(
-                    f"{self.log_prefix} get_json_course_data got status code {r.status_code} with reason: {r.reason_phrase}\nRetrying..."
-                )
-                retries += 1
-                continue
+        if not force and not session.needs_auth():
+            return True
 
-            try:
-                j = r.json()
-            except json.JSONDecodeError as e:
-                logging.warning("Did not get valid json response! Retrying...")
-                retries += 1
-                continue
+        logging.info(f"{self.log_prefix} Refreshing terms auth")
 
+        r = self.request(
+            "get",
+            self.term_auth_url,
+            endpoint=ENDPOINT_AUTH,
+            client=session.client,
+            timeout=self.auth_timeout_seconds,
+        )
 
-            data = j.get("data", None)
+        return self.read_auth(r, session)
 
-            if not data:
-                logging.warning(
-                    f"Got json response for course data but no data??? {j}\nRetrying..."
-                )
-                retries += 1
-                continue
+    def bind_term(self, term_id: str, session: BannerSession = None):
+        """
+        Makes sure the banner session searches in the given term, only talks to the server
+        if the session is not already bound to it
+        """
+        session = session or self.banner_session
 
-            if len(data) >= API_COURSE_DATAS_LIMIT:
-                course_code_send_amount = course_code_send_amount // 2
-                logging.warning(
-                    f"Got {API_COURSE_DATAS_LIMIT} course datas, which is the known api truncation point, retrying with {course_code_send_amount} course codes..."
-                )
+        if not session.needs_term(term_id):
+            return True
 
-                if course_code_send_amount == 0:
-                    raise Exception("course_code_send_amount has halved until 0!")
+        if not self.auth_terms(session=session):
+            return False
 
-                continue
+        logging.debug(f"{self.log_prefix} Binding session to term {term_id}")
 
-            sent_course_codes += len(sublist)
+        r = self.request(
+            "get", self.term_search_url(term_id), endpoint=ENDPOINT_TERM_SEARCH, client=session.client
+        )
 
-            yield j
+        return self.read_bound_term(r, term_id, session)
 
-        return {}
+    def get_json_terms(self, max_count: int = MAX_COUNT, session: BannerSession = None):
+        session = session or self.banner_session
 
+        self.auth_terms(session=session)
 
-    def get_course_restrictions(self, term: int, crn: int) -> bytes:
-        self.auth_terms()
+        r = self.request(
+            "get", self.terms_url(max_count), endpoint=ENDPOINT_TERMS, client=session.client
+        )
 
-        url = TERM_SEARCH_GET_RESTRICTION.format(HOST=self.hostname, TERM=term, CRN=crn)
-        r = self.request("get", url)
+        return self.read_json(r, "get_json_terms")
 
-        if r is None:
-            logging.warning(
-                f"{self.log_prefix} get_course_restrictions got None response."
-            )
-            return {"levels": [], "degrees": []}
+    def get_json_course_codes(
+        self,
+        term_id: str,
+        search_code: str = "",
+        max_count: int = MAX_COUNT,
+        session: BannerSession = None,
+    ):
+        session = session or self.banner_session
 
-        if r.status_code != 200:
-            return {"levels": [], "degrees": []}
+        self.auth_terms(session=session)
 
-        j = r.content
+        url = self.course_codes_url(term_id, search_code, max_count)
 
-        page = BeautifulSoup(j, "html.parser")
-        spans = page.find_all("span")
+        r = self.request("get", url, endpoint=ENDPOINT_COURSE_CODES, client=session.client)
 
-        restrictions = {}
-        current = None
-        must_be_in = False
-        for i in spans:
-            m = MATCHES_RESTRICTION_GROUP.match(i.text)
+        return self.read_json(r, "get_json_course_codes")
 
-            if m:
-                must_be_in = m.group(1).lower() == "must"
-                group = m.group(2).lower()
+    def get_json_course_data(
+        self,
+        term_id: str,
+        course_codes: list[str] = None,
+        max_count: int = MAX_COUNT,
+        retry_amount=5,
+        session: BannerSession = None,
+        section_counts: dict[str, int] = None,
+    ):
+        session = session or self.banner_session
 
-                if group in restrictions:
-                    current = restrictions[group]
+        fetch = CourseDataFetch(
+            self, term_id, course_codes, max_count, retry_amount, section_counts, session
+        )
 
-                else:
-                    current = []
-                    restrictions[group] = current
+        while fetch.next_batch() is not None:
 
-            elif MATCHES_RESTRICTION_SPECIAL.match(i.text):
-                s = "special"
-                if s in restrictions:
-                    current = restrictions[s]
-                else:
-                    current = []
-                    restrictions[s] = current
+            if not self.bind_term(term_id, session):
+                fetch.bind_failed()
+                continue
 
-            elif current is not None and "detail-popup-indentation" in i["class"]:
-                current.append({"value": i.text, "must_be_in": must_be_in})
+            if DumperConfig.hedge_course_data:
+                r = self.hedged_request(
+                    "get", fetch.url(), endpoint=ENDPOINT_COURSE_DATA, client=session.client
+                )
             else:
-                if i.text == "Not all restrictions are applicable.":
-                    continue
-                logging.warn(f"Unknown span while parsing restrictions: {i}")
+                r = self.request(
+                    "get", fetch.url(), endpoint=ENDPOINT_COURSE_DATA, client=session.client
+                )
+
+            j = fetch.read_response(r)
+
+            if j is None:
+                continue
+
+            yield j
+
+            # the batch belongs to the caller now, do not keep it alive during the next request
+            r = j = None
+
+        return {}
+
+
+    def get_course_restrictions(self, term: int, crn: int, session: BannerSession = None) -> bytes:
+        session = session or self.banner_session
 
-        return restrictions
+        self.auth_terms(session=session)
+
+        r = self.request(
+            "get", self.restrictions_url(term, crn), endpoint=ENDPOINT_RESTRICTIONS, client=session.client
+        )
+
+        return self.read_restrictions(r)
 
     def __depricated__scrape_and_dump(self):
         print("getting terms...")
@@ -333,6 +702,10 @@ class CourseDumper(CourseScraper):
 
         return
 
+    def close(self):
+        for session in self.banner_sessions:
+            session.client.close()
+
     def scrape_and_dump(self, debug_break_1=False):
 
         self.school_id = database.get_school_id(self.SCHOOL_VALUE, self.SUBDOMAIN, self.TIMEZONE)
@@ -341,118 +714,434 @@ class CourseDumper(CourseScraper):
 
         logging.info(f"Scraping using dumper: {self}")
 
-        currentYear = (datetime.now().year - 1) * 100
-        logging.info(f"Current term year: {currentYear}")
+        real_term_id, term_desc = self.split_current_terms(terms)
 
-        real_term_id_and_desc = list(
-            filter(
-                lambda x: int(x[0]) >= currentYear, [(i["code"], i["description"]) for i in terms]
+        internal_term_ids = database.add_terms(self.school_id, real_term_id, term_desc)
+
+        logging.info(f"Found term {real_term_id}")
+
+        free_sessions = queue.Queue()
+
+        for session in self.banner_sessions:
+            free_sessions.put(session)
+
+        def scrape_term_with_session(real_id: str, internal_id: int):
+            session = free_sessions.get()
+
+            try:
+                self.scrape_term(real_id, internal_id, session)
+
+            except resilience.CircuitOpenError:
+                raise
+
+            except Exception as e:
+                self.log_term_failure(real_id, e)
+
+            finally:
+                free_sessions.put(session)
+
+        with ThreadPoolExecutor(max_workers=len(self.banner_sessions)) as pool:
+            futures = [
+                pool.submit(scrape_term_with_session, real_id, internal_id)
+                for real_id, internal_id in self.get_terms_to_scrape(
+                    real_term_id, internal_term_ids, debug_break_1
+                )
+            ]
+
+            for future in futures:
+                future.result()
+
+    def scrape_term(self, real_id: str, internal_id: int, session: BannerSession):
+        logging.info(f"Fetching term {real_id}")
+        course_codes = self.get_json_course_codes(real_id, "", session=session)
+
+        course_code, course_desc = self.split_course_codes(real_id, course_codes)
+
+        del course_codes
+
+        logging.debug(f"Got course codes {course_code}")
+
+        i = database.add_courses(
+            [internal_id for i in range(len(course_desc))], course_code, course_desc
+        )
+
+        # how many sections each course had last time, so the requests can be packed by it
+        section_counts = database.get_section_counts(internal_id)
+
+        # the whole term is merged at once at the end instead of writing every batch
+        load = database.TermLoad(self.school_id) if database.WriteConfig.merge_terms else None
+
+        writes = self.term_writes(real_id, internal_id)
+
+        logging.info(f"Fetching course data for term and {len(course_code)} courses")
+        for course_data in prefetch(
+            self.get_json_course_data(
+                real_id, course_code, session=session, section_counts=section_counts
+            ),
+            DumperConfig.prefetch_depth,
+        ):
+            if not course_data:
+                logging.info("Could not get course data")
+                continue
+
+            course_data = course_data["data"]
+            course_data_str = str(course_data)[0:200]
+            logging.debug(f"Course data gotten: {course_data_str}")
+
+            proper_course_id = self.map_course_ids(course_code, i, course_data)
+            # restrictions = [dumper.get_course_restrictions(id, i['courseReferenceNumber']) for i in course_data]
+
+            logging.info(
+                f"proper_course_id length = {len(proper_course_id)}, course_data length = {len(course_data)}"
             )
+
+            # with open("debug1.json", "w")as writer:
+            #     json.dump(proper_course_id, writer, indent=3)
+
+            if load is not None:
+                load.add(proper_course_id, course_data)
+
+            else:
+                # written by the database writers, this only waits if they are behind
+                pipeline.submit(
+                    database.add_course_data,
+                    self.school_id,
+                    proper_course_id,
+                    course_data,
+                    group=writes,
+                )
+                # database.add_course_data(proper_course_id, course_data, restrictions)
+
+            # only the writer or the load needs the sections now, do not keep them alive from here
+            course_data = proper_course_id = None
+
+        if load is not None:
+            pipeline.submit(database.merge_term, load, group=writes)
+
+        # marked done once the writers got every write of the term into the database
+        writes.close()
+
+
+class AsyncCourseDumper(CourseDumperBase, AsyncCourseScraper):
+    """
+    asyncio version of CourseDumper, runs the school's scrape on the current event loop
+
+    usage: AsyncCourseDumper(UOIT_Dumper)
+    """
+
+    def __init__(self, school: type[CourseDumper], retries=5, timeout=DEFAULT_TIMEOUT) -> None:
+        self.SCHOOL_VALUE = school.SCHOOL_VALUE
+        self.SUBDOMAIN = school.SUBDOMAIN
+        self.TIMEZONE = school.TIMEZONE
+
+        super().__init__(school.HOSTNAME, school.MEP_CODE, retries, timeout)
+
+    def __repr__(self) -> str:
+        return f"<AsyncCourseDumper {self.SCHOOL_VALUE}>"
+
+    async def auth_terms(self, force: bool = False, session: BannerSession = None):
+        session = session or self.banner_session
+
+        if not force and not session.needs_auth():
+            return True
+
+        logging.info(f"{self.log_prefix} Refreshing terms auth")
+
+        r = await self.request(
+            "get",
+            self.term_auth_url,
+            endpoint=ENDPOINT_AUTH,
+            client=session.client,
+            timeout=self.auth_timeout_seconds,
         )
 
-        real_term_id = [i[0] for i in real_term_id_and_desc]
-        term_desc = [i[1] for i in real_term_id_and_desc]
+        return self.read_auth(r, session)
 
-        internal_term_ids = database.add_terms(self.school_id, real_term_id, term_desc)
+    async def bind_term(self, term_id: str, session: BannerSession = None):
+        """
+        Makes sure the banner session searches in the given term, only talks to the server
+        if the session is not already bound to it
+        """
+        session = session or self.banner_session
+
+        if not session.needs_term(term_id):
+            return True
+
+        if not await self.auth_terms(session=session):
+            return False
+
+        logging.debug(f"{self.log_prefix} Binding session to term {term_id}")
+
+        r = await self.request(
+            "get", self.term_search_url(term_id), endpoint=ENDPOINT_TERM_SEARCH, client=session.client
+        )
+
+        return self.read_bound_term(r, term_id, session)
+
+    async def get_json_terms(self, max_count: int = MAX_COUNT, session: BannerSession = None):
+        session = session or self.banner_session
+
+        await self.auth_terms(session=session)
+
+        r = await self.request(
+            "get", self.terms_url(max_count), endpoint=ENDPOINT_TERMS, client=session.client
+        )
+
+        return self.read_json(r, "get_json_terms")
+
+    async def get_json_course_codes(
+        self,
+        term_id: str,
+        search_code: str = "",
+        max_count: int = MAX_COUNT,
+        session: BannerSession = None,
+    ):
+        session = session or self.banner_session
+
+        await self.auth_terms(session=session)
+
+        url = self.course_codes_url(term_id, search_code, max_count)
+
+        r = await self.request("get", url, endpoint=ENDPOINT_COURSE_CODES, client=session.client)
+
+        return self.read_json(r, "get_json_course_codes")
+
+    async def get_json_course_data(
+        self,
+        term_id: str,
+        course_codes: list[str] = None,
+        max_count: int = MAX_COUNT,
+        retry_amount=5,
+        session: BannerSession = None,
+        section_counts: dict[str, int] = None,
+    ):
+        session = session or self.banner_session
+
+        fetch = CourseDataFetch(
+            self, term_id, course_codes, max_count, retry_amount, section_counts, session
+        )
+
+        while fetch.next_batch() is not None:
+
+            if not await self.bind_term(term_id, session):
+                fetch.bind_failed()
+                continue
+
+            if DumperConfig.hedge_course_data:
+                r = await self.hedged_request(
+                    "get", fetch.url(), endpoint=ENDPOINT_COURSE_DATA, client=session.client
+                )
+            else:
+                r = await self.request(
+                    "get", fetch.url(), endpoint=ENDPOINT_COURSE_DATA, client=session.client
+                )
+
+            j = fetch.read_response(r)
+
+            if j is None:
+                continue
+
+            yield j
+
+            # the batch belongs to the caller now, do not keep it alive during the next request
+            r = j = None
+
+    async def get_course_restrictions(self, term: int, crn: int, session: BannerSession = None):
+        session = session or self.banner_session
+
+        await self.auth_terms(session=session)
+
+        r = await self.request(
+            "get", self.restrictions_url(term, crn), endpoint=ENDPOINT_RESTRICTIONS, client=session.client
+        )
+
+        return self.read_restrictions(r)
+
+    async def aclose(self):
+        for session in self.banner_sessions:
+            await session.client.aclose()
+
+    async def scrape_and_dump(self, debug_break_1=False):
+        # only runs once per school, so it only has a blocking version that is run off the event loop
+        self.school_id = await asyncio.to_thread(
+            database.get_school_id, self.SCHOOL_VALUE, self.SUBDOMAIN, self.TIMEZONE
+        )
+
+        terms = await self.get_json_terms()
+
+        logging.info(f"Scraping using dumper: {self}")
+
+        real_term_id, term_desc = self.split_current_terms(terms)
+
+        if database.is_async_database():
+            internal_term_ids = await database.aadd_terms(self.school_id, real_term_id, term_desc)
+
+        else:
+            internal_term_ids = await asyncio.to_thread(
+                database.add_terms, self.school_id, real_term_id, term_desc
+            )
 
         logging.info(f"Found term {real_term_id}")
 
-        for real_id, internal_id in zip(real_term_id, internal_term_ids):
-            logging.info(f"Fetching term {real_id}")
-            course_codes = self.get_json_course_codes(real_id, "")
+        free_sessions = asyncio.Queue()
+
+        for session in self.banner_sessions:
+            free_sessions.put_nowait(session)
 
-            course_code = [i["code"] for i in course_codes]
-            course_desc = [i["description"] for i in course_codes]
+        async def scrape_term_with_session(real_id: str, internal_id: int):
+            session = await free_sessions.get()
 
-            logging.debug(f"Got course codes {course_code}")
+            try:
+                await self.scrape_term(real_id, internal_id, session)
 
-            i = database.add_courses(
-                [internal_id for i in range(len(course_desc))], course_code, course_desc
+            except resilience.CircuitOpenError:
+                raise
+
+            except Exception as e:
+                self.log_term_failure(real_id, e)
+
+            finally:
+                free_sessions.put_nowait(session)
+
+        await asyncio.gather(
+            *(
+                scrape_term_with_session(real_id, internal_id)
+                for real_id, internal_id in self.get_terms_to_scrape(
+                    real_term_id, internal_term_ids, debug_break_1
+                )
             )
+        )
+
+    async def write(self, writes: pipeline.WriteGroup, function, *args):
+        """
+        Writes with the async version of function on the asyncio engine if there is one,
+        otherwise hands it to the database writers
+        """
+        if not database.is_async_database():
+            await asyncio.to_thread(pipeline.submit, function, *args, group=writes)
+            return
+
+        writes.add()
+
+        try:
+            await ASYNC_WRITES[function](*args)
+
+        except Exception as e:
+            writes.finished(e)
+            raise
+
+        writes.finished()
+
+    async def scrape_term(self, real_id: str, internal_id: int, session: BannerSession):
+        logging.info(f"Fetching term {real_id}")
+        course_codes = await self.get_json_course_codes(real_id, "", session=session)
+
+        course_code, course_desc = self.split_course_codes(real_id, course_codes)
+
+        del course_codes
+
+        term_ids = [internal_id for _ in range(len(course_desc))]
+
+        if database.is_async_database():
+            i = await database.aadd_courses(term_ids, course_code, course_desc)
 
-            logging.info(f"Fetching course data for term and {len(course_code)} courses")
-            for course_data in self.get_json_course_data(real_id, course_code):
-                if not course_data:
-                    logging.info("Could not get course data")
-                    continue
+            section_counts = await database.aget_section_counts(internal_id)
 
-                course_data = course_data["data"]
-                course_data_str = str(course_data)[0:200]
-                logging.debug(f"Course data gotten: {course_data_str}")
+        else:
+            i = await asyncio.to_thread(database.add_courses, term_ids, course_code, course_desc)
 
-                # NOTE: assuming course_code and i are in order (they should be), this works fine
-                #       otherwise we probably need to query the db for every course data we insert
-                course_id_map = {course_code: j for course_code, j in zip(course_code, i)}
-                proper_course_id = [course_id_map[i["subjectCourse"]] for i in course_data]
-                # restrictions = [dumper.get_course_restrictions(id, i['courseReferenceNumber']) for i in course_data]
+            section_counts = await asyncio.to_thread(database.get_section_counts, internal_id)
 
-                logging.info(
-                    f"proper_course_id length = {len(proper_course_id)}, course_data length = {len(course_data)}"
+        # the whole term is merged at once at the end instead of writing every batch
+        load = None
+
+        if database.WriteConfig.merge_terms:
+            load = await asyncio.to_thread(database.TermLoad, self.school_id)
+
+        writes = self.term_writes(real_id, internal_id)
+
+        logging.info(f"Fetching course data for term and {len(course_code)} courses")
+        async for course_data in aprefetch(
+            self.get_json_course_data(
+                real_id, course_code, session=session, section_counts=section_counts
+            ),
+            DumperConfig.prefetch_depth,
+        ):
+            course_data = course_data["data"]
+
+            proper_course_id = self.map_course_ids(course_code, i, course_data)
+
+            if load is not None:
+                # resolving the class types, subjects and faculty can hit the database
+                await asyncio.to_thread(load.add, proper_course_id, course_data)
+
+            else:
+                await self.write(
+                    writes, database.add_course_data, self.school_id, proper_course_id, course_data
                 )
 
-                # with open("debug1.json", "w")as writer:
-                #     json.dump(proper_course_id, writer, indent=3)
+            # only the writer or the load needs the sections now, do not keep them alive from here
+            course_data = proper_course_id = None
 
-                database.add_course_data(self.school_id, proper_course_id, course_data)
-                # database.add_course_data(proper_course_id, course_data, restrictions)
+        if load is not None:
+            await self.write(writes, database.merge_term, load)
+
+        writes.close()
 
-            if debug_break_1:
-                logging.error("DEBUG BREAK")
-                return
+
+# the asyncio engine version of every write AsyncCourseDumper.write can be given
+ASYNC_WRITES = {
+    database.add_course_data: database.aadd_course_data,
+    database.merge_term: database.amerge_term,
+}
 
 
 class UOIT_Dumper(CourseDumper):
     SCHOOL_VALUE = "Ontario Tech University - Canada"
     SUBDOMAIN = "otu"
     TIMEZONE = "America/Toronto"
-
-    def __init__(self) -> None:
-        super().__init__("ssp.mycampus.ca", "UOIT")
+    HOSTNAME = "ssp.mycampus.ca"
+    MEP_CODE = "UOIT"
 
 
 class UVIC_Dumper(CourseDumper):
     SCHOOL_VALUE = "University of Victoria - Canada"
     SUBDOMAIN = "uv"
     TIMEZONE = "America/Vancouver"
-
-    def __init__(self) -> None:
-        super().__init__("banner.uvic.ca", "UVIC")
+    HOSTNAME = "banner.uvic.ca"
+    MEP_CODE = "UVIC"
 
 
 class DC_Dumper(CourseDumper):
     SCHOOL_VALUE = "Durham College - Canada"
     SUBDOMAIN = "dc"
     TIMEZONE = "America/Toronto"
-
-    def __init__(self) -> None:
-        super().__init__("ssp.mycampus.ca", "DC")
+    HOSTNAME = "ssp.mycampus.ca"
+    MEP_CODE = "DC"
 
 
 class TTU_Dumper(CourseDumper):
     SCHOOL_VALUE = "Texas Tech University - USA"
     SUBDOMAIN = "ttu"
     TIMEZONE = "America/Chicago"
-
-    def __init__(self) -> None:
-        super().__init__("registration.texastech.edu", "TTU")
+    HOSTNAME = "registration.texastech.edu"
+    MEP_CODE = "TTU"
 
 
 class RDP_Dumper(CourseDumper):
     SCHOOL_VALUE = "Red Deer Polytechnic - Canada"
     SUBDOMAIN = "rdp"
     TIMEZONE = "America/Edmonton"
-
-    def __init__(self) -> None:
-        super().__init__("myinfo.rdc.ab.ca", "")
+    HOSTNAME = "myinfo.rdc.ab.ca"
+    MEP_CODE = ""
 
 
 class OC_Dumper(CourseDumper):
     SCHOOL_VALUE = "Okanagan College - Canada"
     SUBDOMAIN = "oc"
     TIMEZONE = "America/Vancouver"
-
-    def __init__(self) -> None:
-        super().__init__("selfservice.okanagan.bc.ca", "")
+    HOSTNAME = "selfservice.okanagan.bc.ca"
+    MEP_CODE = ""
 
 
 class TRU_Dumper(CourseDumper):
@@ -464,33 +1153,29 @@ class TRU_Dumper(CourseDumper):
     SCHOOL_VALUE = "Thompson Rivers University - Canada"
     SUBDOMAIN = "tru"
     TIMEZONE = "America/Vancouver"
-
-    def __init__(self) -> None:
-        super().__init__("reg-prod.ec.tru.ca", "")
+    HOSTNAME = "reg-prod.ec.tru.ca"
+    MEP_CODE = ""
 
 
 class KPU_Dumper(CourseDumper):
     SCHOOL_VALUE = "Kwantlen Polytechnic University - Canada"
     SUBDOMAIN = "kpu"
     TIMEZONE = "America/Vancouver"
-
-    def __init__(self) -> None:
-        super().__init__("banweb3.kpu.ca", "")
+    HOSTNAME = "banweb3.kpu.ca"
+    MEP_CODE = ""
 
 
 class UOS_Dumper(CourseDumper):
     SCHOOL_VALUE = "University of Saskatchewan - Canada"
     SUBDOMAIN = "uos"
     TIMEZONE = "America/Regina"
-
-    def __init__(self) -> None:
-        super().__init__("banner.usask.ca", "")
+    HOSTNAME = "banner.usask.ca"
+    MEP_CODE = ""
 
 
 class YU_Dumper(CourseDumper):
     SCHOOL_VALUE = "Yukon University - Canada"
     SUBDOMAIN = "yu"
     TIMEZONE = "America/Whitehorse"
-
-    def __init__(self) -> None:
-        super().__init__("banner.yukonu.ca", "")
+    HOSTNAME = "banner.yukonu.ca"
+    MEP_CODE = ""
@@ -0,0 +1,129 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import asyncio
+import threading
+from typing import AsyncIterable, Iterable
+
+"""
+Runs a generator ahead of whoever is consuming it, so the next course data batches
+download while the current one is written to the database.
+"""
+
+# put after the last item, along with the exception the producer died with if it did
+_DONE = object()
+
+# how often a blocked producer checks if the consumer went away
+_STOP_CHECK_SECONDS = 0.5
+
+
+def prefetch(iterable: Iterable, depth: int):
+    """
+    Iterates the iterable on a background thread, keeping up to depth items ready
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item, error=None):
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=_STOP_CHECK_SECONDS)
+                return True
+
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+
+            else:
+                put(_DONE)
+
+        except BaseException as e:
+            put(_DONE, e)
+
+        finally:
+            close = getattr(iterable, "close", None)
+
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+
+            if item is _DONE:
+                if error is not None:
+                    raise error
+
+                return
+
+            yield item
+
+    finally:
+        # the producer could be in the middle of a request, it exits on its next put
+        stop.set()
+
+
+async def aprefetch(iterable: AsyncIterable, depth: int):
+    """
+    Iterates the async iterable in its own task, keeping up to depth items ready
+    """
+    if depth <= 0:
+        async for item in iterable:
+            yield item
+        return
+
+    items = asyncio.Queue(maxsize=depth)
+
+    async def produce():
+        try:
+            async for item in iterable:
+                await items.put((item, None))
+
+            await items.put((_DONE, None))
+
+        except Exception as e:
+            await items.put((_DONE, e))
+
+    task = asyncio.create_task(produce())
+
+    try:
+        while True:
+            item, error = await items.get()
+
+            if item is _DONE:
+                if error is not None:
+                    raise error
+
+                return
+
+            yield item
+
+    finally:
+        task.cancel()
@@ -0,0 +1,99 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import threading
+
+import logging
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+"""
+Process wide counters for the things we want to see at the end of a run.
+"""
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_quarantined: list[tuple[str, str, str, int]] = []
+
+
+def increment(name: str, amount: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def get(name: str):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def record_quarantine(hostname: str, term_id: str, course_code: str, cost: int):
+    """
+    A course code was given up on after cost requests were spent trying to get it
+    """
+    with _lock:
+        _quarantined.append((hostname, str(term_id), course_code, cost))
+
+        _counters["course_data.quarantined"] = _counters.get("course_data.quarantined", 0) + 1
+        _counters["course_data.quarantine_cost"] = _counters.get("course_data.quarantine_cost", 0) + cost
+
+
+def get_quarantined():
+    with _lock:
+        return list(_quarantined)
+
+
+def log_metrics():
+    with _lock:
+        counters = sorted(_counters.items())
+        quarantined = list(_quarantined)
+
+    for name, value in counters:
+        logging.info(f"Metric: {name} = {value:g}")
+
+    for hostname, term_id, course_code, cost in quarantined:
+        logging.warning(
+            f"Quarantined course {course_code} of term {term_id} on {hostname} after {cost} requests"
+        )
+
+
+def get_peak_rss():
+    """
+    The most memory the process has used so far in bytes, None if it can not be read here
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports it in kilobytes, mac in bytes
+    if sys.platform == "darwin":
+        return peak
+
+    return peak * 1024
+
+
+def log_peak_rss():
+    peak = get_peak_rss()
+
+    if peak is None:
+        logging.info("Peak memory usage is not available on this platform")
+        return
+
+    logging.info(f"Peak memory usage {peak / (1024 * 1024):.1f} MiB")
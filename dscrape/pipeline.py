@@ -0,0 +1,243 @@
+# Copyright (C) 2022-2023 EZCampus 
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import threading
+import traceback
+from typing import Callable
+
+from . import dataUtil
+from . import metrics
+
+import logging
+
+"""
+Hands the course data writes from the extractors to a few dedicated database writer threads.
+
+The extractors only fetch and parse, and put what they got into a bounded queue. When the writers
+fall behind the queue fills up and the extractors wait, and when the extractors are slow the writers
+wait on the queue. Network and database concurrency can then be sized separately, and the database
+only ever sees as many write transactions at once as there are writers.
+"""
+
+
+class PipelineConfig:
+    writers = 2
+
+    # batches that can wait for a writer before the extractors are slowed down
+    queue_size = 8
+
+
+# tells a writer to exit
+_STOP = None
+
+
+class WriteGroup:
+    """
+    The writes of one term, on_complete is called once the group was closed
+    and every write in it went through, never if one of them failed
+    """
+
+    def __init__(self, name: str, on_complete: Callable[[], None]) -> None:
+        self.name = name
+        self.on_complete = on_complete
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.closed = False
+        self.failed = False
+        self.completed = False
+
+    def __repr__(self) -> str:
+        return f"<WriteGroup {self.name} pending={self.pending} failed={self.failed}>"
+
+    def add(self):
+        with self.lock:
+            self.pending += 1
+
+    def finished(self, error: Exception = None):
+        """
+        A write of the group is done, error is what it raised if it failed
+        """
+        with self.lock:
+            self.pending -= 1
+
+            if error is not None and not self.failed:
+                self.failed = True
+
+                logging.error(f"A write of {self.name} failed, it will not be marked as complete")
+
+        self._check()
+
+    def close(self):
+        """
+        Every write of the group was submitted
+        """
+        with self.lock:
+            self.closed = True
+
+        self._check()
+
+    def _check(self):
+        with self.lock:
+            if not self.closed or self.pending or self.failed or self.completed:
+                return
+
+            self.completed = True
+
+        self.on_complete()
+
+
+class WritePipeline:
+    def __init__(self, writers: int = None, queue_size: int = None) -> None:
+        self.writers = PipelineConfig.writers if writers is None else writers
+        self.queue_size = PipelineConfig.queue_size if queue_size is None else queue_size
+
+        self.jobs = queue.Queue(maxsize=self.queue_size)
+        self.threads: list[threading.Thread] = []
+
+    def __repr__(self) -> str:
+        return f"<WritePipeline writers={self.writers} queued={self.jobs.qsize()}/{self.queue_size}>"
+
+    def start(self):
+        for i in range(self.writers):
+            thread = threading.Thread(target=self._work, name=f"db-writer-{i}", daemon=True)
+            thread.start()
+
+            self.threads.append(thread)
+
+        logging.info(f"Started {self}")
+
+    def submit(self, function: Callable, *args, group: WriteGroup = None):
+        """
+        Queues a write, blocks while the queue is full
+        """
+        started_at = dataUtil.time_now_precise()
+
+        if group is not None:
+            group.add()
+
+        self.jobs.put((function, args, group))
+
+        metrics.increment("pipeline.submit_wait_seconds", dataUtil.time_now_precise() - started_at)
+
+    def close(self):
+        """
+        Waits for every queued write to finish and stops the writers
+        """
+        for _ in self.threads:
+            self.jobs.put(_STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads.clear()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+
+            if job is _STOP:
+                return
+
+            function, args, group = job
+
+            started_at = dataUtil.time_now_precise()
+            error = None
+
+            try:
+                function(*args)
+
+                metrics.increment("pipeline.writes")
+
+            except Exception as e:
+                error = e
+
+                metrics.increment("pipeline.failed_writes")
+
+                logging.error(f"Database write {function.__name__} failed")
+                logging.error(e)
+                logging.error(traceback.format_exc())
+
+            finally:
+                metrics.increment("pipeline.write_seconds", dataUtil.time_now_precise() - started_at)
+
+                # do not hold on to the written batch while waiting for the next one
+                job = function = args = None
+
+            if group is not None:
+                group.finished(error)
+
+            group = error = None
+
+
+_lock = threading.Lock()
+_pipeline: WritePipeline = None
+
+
+def configure(writers: int = None, queue_size: int = None):
+    if writers is not None:
+        PipelineConfig.writers = writers
+
+    if queue_size is not None:
+        PipelineConfig.queue_size = queue_size
+
+
+def start():
+    global _pipeline
+
+    with _lock:
+        if _pipeline is None:
+            _pipeline = WritePipeline()
+            _pipeline.start()
+
+
+def stop():
+    global _pipeline
+
+    with _lock:
+        pipeline = _pipeline
+        _pipeline = None
+
+    if pipeline is not None:
+        pipeline.close()
+
+
+def submit(function: Callable, *args, group: WriteGroup = None):
+    """
+    Queues the write on the writers if the pipeline is running, otherwise writes right away
+    """
+    with _lock:
+        pipeline = _pipeline
+
+    if pipeline is not None:
+        pipeline.submit(function, *args, group=group)
+        return
+
+    if group is None:
+        return function(*args)
+
+    group.add()
+
+    try:
+        result = function(*args)
+
+    except Exception as e:
+        group.finished(e)
+        raise
+
+    group.finished()
+
+    return result